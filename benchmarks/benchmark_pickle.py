@@ -0,0 +1,107 @@
+"""
+Compares the size of pickled beliefstates, and the time to pickle and unpickle
+them, between the compact pickling protocol of cells and the previous one,
+which pickled every attribute of every cell and the referential domain.  The
+compact pickles embed the referential domain, unless it is registered (see
+beliefs.cells.registry).
+
+    $ PYTHONPATH=src python benchmarks/benchmark_pickle.py [number of entities] [number of states]
+"""
+import copy_reg
+import pickle
+import cPickle
+import sys
+import timeit
+from beliefs import *
+from beliefs.cells import *
+from beliefs.cells import registry
+
+
+class Shape(DictCell):
+    """ A colored shape in the referential domain """
+    def __init__(self, num=0, color='yellow', shape='triangle', size=0):
+        DictCell.__init__(self, {'num': IntervalCell(num, num),
+            'color': SetIntersectionCell(['yellow', 'green', 'red'], [color]),
+            'shape': StringCell(shape),
+            'size': IntervalCell(size, size)})
+
+
+class ShapeDomain(object):
+    """ A referential domain of `n` shapes """
+    def __init__(self, n):
+        specs = [('yellow', 'triangle', 70), ('green', 'triangle', 62),
+                 ('green', 'triangle', 60), ('yellow', 'circle', 80)]
+        self.cells = [Shape(num, *specs[num % len(specs)]) for num in xrange(n)]
+
+    def iter_entities(self):
+        return iter(self.cells)
+
+
+class LegacyPickler(pickle.Pickler):
+    """ Pickles cells with all of their attributes, as they were pickled before
+    they had __getstate__ """
+
+    def save(self, obj):
+        if not isinstance(obj, Cell):
+            return pickle.Pickler.save(self, obj)
+        memoized = self.memo.get(id(obj))
+        if memoized is not None:
+            self.write(self.get(memoized[0]))
+            return
+        state = obj.__dict__.copy()
+        state.pop('_hash', None)
+        state.pop('_fingerprint', None)
+        state.pop('_parents', None)
+        if isinstance(obj, BeliefState):
+            # the caches that did not exist then
+            for key in BeliefState.DERIVED:
+                state.pop(key, None)
+        self.save_reduce(copy_reg.__newobj__, (obj.__class__,), state, obj=obj)
+
+
+def legacy_dumps(obj):
+    from cStringIO import StringIO
+    out = StringIO()
+    LegacyPickler(out, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return out.getvalue()
+
+
+def make_states(entities, states):
+    """ Beliefstates with a few constraints each """
+    belief = BeliefState(ShapeDomain(entities))
+    ColumnarDomain.for_domain(belief.__dict__['referential_domain'])  # registers domains
+    results = []
+    for i in xrange(states):
+        state = belief.copy()
+        state.merge(['target', 'size'], 60 + i % 20, '__ge__')
+        state.merge(['target', 'color'], ['yellow', 'green'])
+        state.merge(['targetset_arity'], 1 + i % 3, '__ge__')
+        results.append(state)
+    return results
+
+
+def measure(name, dumps, loads, states, repeat=3):
+    payload = dumps(states)
+    dump_time = min(timeit.repeat(lambda: dumps(states), number=1, repeat=repeat))
+    load_time = min(timeit.repeat(lambda: loads(payload), number=1, repeat=repeat))
+    assert loads(payload) == states
+    print "%-30s %10i bytes %9.2f ms pickle %9.2f ms unpickle" % \
+            (name, len(payload), dump_time * 1000, load_time * 1000)
+
+
+def main(entities=1000, states=200):
+    states = make_states(entities, states)
+    protocol = pickle.HIGHEST_PROTOCOL
+    print "%i beliefstates over %i entities" % (len(states), entities)
+    measure("previous (pickle)", legacy_dumps, pickle.loads, states)
+    measure("compact (pickle)", lambda obj: pickle.dumps(obj, protocol),
+            pickle.loads, states)
+    measure("compact (cPickle)", lambda obj: cPickle.dumps(obj, protocol),
+            cPickle.loads, states)
+    registry.register(states[0].__dict__['referential_domain'], 'shapes')
+    measure("compact, registered (cPickle)", lambda obj: cPickle.dumps(obj, protocol),
+            cPickle.loads, states)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
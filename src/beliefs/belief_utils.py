@@ -186,8 +186,76 @@ def choose(n, k):
         return 0
 
 def binomial_range(n, k_low, k_high):
+    """
+    Returns the sum of the binomial coefficients C(n, k) for k_low <= k <= k_high.
+
+    Consecutive coefficients are derived from each other, C(n, k+1) =
+    C(n, k) * (n-k) / (k+1), and when the range covers most of [0, n] the
+    (shorter) complement is subtracted from 2^n instead.
+    """
+    k_low, k_high = max(k_low, 0), min(k_high, n)
     if k_low > k_high: return 0
-    return sum([choose(n, i) for i in range(k_low, k_high+1)])
+    if 2 * (k_high - k_low + 1) > n + 1:
+        return 2**n - binomial_range(n, 0, k_low-1) - binomial_range(n, k_high+1, n)
+    term = choose(n, k_low)
+    total = term
+    for k in xrange(k_low, k_high):
+        term = term * (n - k) // (k + 1)
+        total += term
+    return total
+
+def unrank_combination(n, k, rank):
+    """
+    Returns the `rank`-th k-combination of range(n), in the lexicographic order
+    used by itertools.combinations, with O(n) arithmetic operations.
+
+       unrank_combination(4, 2, 0) ==> (0, 1)
+       unrank_combination(4, 2, 5) ==> (2, 3)
+    """
+    if not 0 <= rank < choose(n, k):
+        raise IndexError("No %i-combination of %i elements with rank %i" % (k, n, rank))
+    combination = []
+    x = 0
+    r = k - 1
+    # c is the number of combinations whose next element is x: C(n-x-1, r)
+    c = choose(n - 1, r)
+    while r >= 0:
+        m = n - x - 1
+        if rank < c:
+            combination.append(x)
+            if m:
+                c = c * r // m  # C(m-1, r-1)
+            r -= 1
+        else:
+            rank -= c
+            c = c * (m - r) // m  # C(m-1, r)
+        x += 1
+    return tuple(combination)
+
+def iter_combinations(n, k, start=0):
+    """
+    Generates the k-combinations of range(n) in lexicographic order (the order
+    of itertools.combinations), beginning at rank `start` without generating
+    the combinations before it.
+    """
+    if k == 0:
+        if start == 0:
+            yield ()
+        return
+    if start >= choose(n, k):
+        return
+    combination = list(unrank_combination(n, k, start))
+    while True:
+        yield tuple(combination)
+        # advance the rightmost element that has not reached its maximum
+        i = k - 1
+        while i >= 0 and combination[i] == n - k + i:
+            i -= 1
+        if i < 0:
+            return
+        combination[i] += 1
+        for j in xrange(i + 1, k):
+            combination[j] = combination[j - 1] + 1
 
 def test_next_word():
     s1 = "the blue home".split()
@@ -1,8 +1,12 @@
 from copy import copy
 from collections import defaultdict
 from beliefs.cells import *
-from belief_utils import choose
+from columns import ColumnarDomain, IntervalColumn, unpack
+from deferred import DeferredEffects
+from cache import persistent
+from belief_utils import choose, binomial_range, iter_combinations, unrank_combination
 import itertools
+import random
 
 class BeliefState(DictCell):
     """
@@ -17,6 +21,8 @@ class BeliefState(DictCell):
     In addition to containing a description of the intended targets, a belief state 
     contains meta-data about combinatoric constraints (such as arity size).
     """
+    # a ResultCache of the results derived from referential domains, if set
+    result_cache = None
 
     def __init__(self, referential_domain=None):
         """ 
@@ -32,15 +38,20 @@ class BeliefState(DictCell):
         self.__dict__['pos'] = 'S'  # syntactic state
         self.__dict__['referential_domain'] = referential_domain
         self.__dict__['environment_variables'] = {}
-        self.__dict__['deferred_effects'] = []
-        
-        if referential_domain:
-            idx = 0
-            for el in referential_domain.iter_entities():
-                if el['num'] != idx:
-                    raise Exception("%ith entity in referential domain does not have 'num' property set correctly" % idx)
-                idx += 1
-                    
+        self.__dict__['deferred_effects'] = DeferredEffects()
+        self.__dict__['domain_columns'] = None
+        # (cell, entity bitmap) of the parts of 'target' and 'distractor', keyed
+        # by keypath, and the cached mask of compatible singletons
+        self.__dict__['singleton_masks'] = {}
+        self.__dict__['singleton_mask'] = None
+        # get_ordered_values() results for a singleton mask: (mask, {key: bounds})
+        self.__dict__['order_statistics'] = None
+        # parts that may be changed in place; None means all of them (see copy)
+        self.__dict__['owned'] = None
+        # records changes while a checkpoint is open (see checkpoint)
+        self.__dict__['trail'] = None
+        # the entities' 'num' properties are checked once per domain, when its
+        # columns are built (see ColumnarDomain)
 
         default_structure = {'target': DictCell(),
                              'distractor': DictCell(),
@@ -51,10 +62,12 @@ class BeliefState(DictCell):
 
         DictCell.__init__(self, default_structure)
 
+    @trailed
     def set_pos(self, pos):
         """ Sets the beliefstates's part of speech, `pos`, and then executes
         any deferred effects that are keyed by that pos tag.
         """
+        self._dirty()
         self.__dict__['pos'] = pos
         # if any deferred effects are keyed by this pos tag, evaluate them, and
         # return their cumulative costs
@@ -64,46 +77,57 @@ class BeliefState(DictCell):
         """ Returns Part of Speech"""
         return self.__dict__['pos']
 
+    @trailed
     def add_deferred_effect(self, effect, pos):
         """ Pushes an (pos, effect) tuple onto a stack to later be executed if the
         state reaches the 'pos'."""
         if not isinstance(pos, (unicode, str)):
             raise Exception("Invalid POS tag. Must be string not %d" % (type(pos)))
         if self['speaker_model']['is_syntax_stacked'] == True:
-            self.__dict__['deferred_effects'].insert(0,(pos, effect,))
+            self._dirty()
+            self.__dict__['deferred_effects'].push(pos, effect)
         elif self['speaker_model']['is_syntax_stacked'] == False:
-            self.__dict__['deferred_effects'].append((pos, effect,))
+            self._dirty()
+            self.__dict__['deferred_effects'].append(pos, effect)
         else:
             raise Contradiction("Speaker Model undefined")
 
+    @trailed
     def execute_deferred_effects(self, pos):
         """ Evaluates deferred effects that are triggered by the prefix of the
         pos on the current beliefstate. For instance, if the effect is triggered
         by the 'NN' pos, then the effect will be triggered by 'NN' or 'NNS'."""
         costs = 0
-        to_delete = []
-        for entry in self.__dict__['deferred_effects']:
-            effect_pos, effect = entry
-            if pos.startswith(effect_pos):
+        # the triggered effects are removed before running them, so that
+        # effects they add are not triggered until the next part of speech
+        if self.__dict__['deferred_effects']:
+            self._dirty()
+        triggered = self.__dict__['deferred_effects'].pop_triggered(pos)
+        for i, (_, effect_pos, effect) in enumerate(triggered):
+            try:
                 costs += effect(self)
-                to_delete.append(entry)
-        # we delete afterwards, because Python cannot delete from a list that
-        # is being iterated over without screwing up the iteration.
-        for entry in to_delete:
-            self.__dict__['deferred_effects'].remove(entry)
+            except Exception:
+                # the effects that did not complete (e.g. with a Contradiction)
+                # stay deferred
+                self.__dict__['deferred_effects'].restore(triggered[i:])
+                raise
         return costs
 
+    @trailed
     def set_environment_variable(self, key, val):
         """ Sets a variable if that variable is not already set """
         if self.get_environment_variable(key) in [None, val]:
+            self._dirty()
             self.__dict__['environment_variables'][key] = val
         else:
             raise Contradiction("Could not set environment variable %s" % (key))
 
+    @trailed
     def get_environment_variable(self, key, default=None, pop=False):
         if key in self.__dict__['environment_variables']:
             val = self.__dict__['environment_variables'][key]
             if pop:
+                self._dirty()
                 del self.__dict__['environment_variables'][key]
             return val
         else:
@@ -153,31 +177,44 @@ class BeliefState(DictCell):
 
         prefix = []
         if on_targets:
-            # apply search to the first target
-            results = []
-            for _, instance in self.iter_singleton_referents():
-                for part in instance:
-                    for entry in find_path_inner(part, prefix[:]):
-                        results.append(['target'] + entry)
-                while results:
-                    yield results.pop()
-                break # only use first instance
+            # apply search to the first target, whose keypaths are indexed
+            instance = self.get_first_singleton_referent()
+            if instance is None:
+                return
+            schema = self.get_domain_columns().schema(instance)
+            results = [path for path, structure in schema.iter_parts(instance) \
+                    if test_function(path[-1], structure)]
+            while results:
+                yield ['target'] + list(results.pop())
         else:
             # apply search to self
             for part in self:
                 for entry in find_path_inner(part, prefix[:]):
                     yield entry
 
+    def get_first_singleton_referent(self):
+        """ Returns the first singleton member of the context set, or None """
+        for _, instance in self.iter_singleton_referents():
+            return instance
+        return None
+
+    def get_target_schema(self):
+        """ Returns the SchemaIndex of the first singleton referent, or None """
+        instance = self.get_first_singleton_referent()
+        if instance is None:
+            return None
+        return self.get_domain_columns().schema(instance)
+
 
     def get_nth_unique_value(self, keypath, n, distance_from, open_interval=True):
         """
         Returns the `n-1`th unique value, or raises
         a contradiction if that is out of bounds
         """
-        unique_values = self.get_ordered_values(keypath, distance_from, open_interval)
+        unique_values = self._ordered_bounds(keypath, distance_from, open_interval)
         if 0 <= n < len(unique_values):
             #logging.error("%i th unique value is %s" % (n, str(unique_values[n])))
-            return unique_values[n]
+            return IntervalCell(*unique_values[n])
         else:
             raise Contradiction("n-th Unique value out of range: " + str(n))
 
@@ -186,54 +223,75 @@ class BeliefState(DictCell):
         Retrieves the referents's values sorted by their distance from the
         min, max, or mid value.
         """
+        return [IntervalCell(low, high) for low, high in \
+                self._ordered_bounds(keypath, distance_from, open_interval)]
 
-        values = []
+    def _ordered_bounds(self, keypath, distance_from, open_interval):
+        """
+        Returns the (low, high) bounds of `get_ordered_values()`, which are cached
+        until the singleton referents change (and, if they are not, may be found
+        in the result cache).
+        """
         if keypath[0] == 'target':
             # instances start with 'target' prefix, but 
             # don't contain it, so we remove it here.
             keypath = keypath[1:]
-        for _, instance in self.iter_singleton_referents():
-            value = instance.get_value_from_path(keypath)
-            if hasattr(value, 'low') and value.low != value.high:
+        mask = self.get_singleton_mask()
+        cached = self.__dict__['order_statistics']
+        if cached is None or cached[0] is not mask:
+            # copies share the cache as long as they share the mask
+            cached = (mask, {})
+            self.__dict__['order_statistics'] = cached
+        key = (tuple(keypath), distance_from, open_interval)
+        if key not in cached[1]:
+            cached[1][key] = self._compute_ordered_bounds(*key)
+        return cached[1][key]
+
+    @persistent('target', 'distractor')
+    def _compute_ordered_bounds(self, keypath, distance_from, open_interval):
+        """ Computes `_ordered_bounds()` from the sorted values of the domain's
+        column at `keypath`, or from the singleton referents' cells """
+        mask = self.get_singleton_mask()
+        column = self.get_domain_columns().columns.get(tuple(keypath))
+        if isinstance(column, IntervalColumn) and not (mask & ~column.present).any():
+            unique_values = column.distinct_values(mask)
+            if unique_values is None:
                 return []
-            values.append(float(value))
+            values = column.low[mask]
+        else:
+            values = []
+            for _, instance in self.iter_singleton_referents():
+                value = instance.get_value_from_path(list(keypath))
+                if hasattr(value, 'low') and value.low != value.high:
+                    return []
+                values.append(float(value))
+            values = np.array(values)
+            unique_values = np.unique(values)
 
         if len(values) == 0:
             return []
-        values = np.array(values)
-        anchor = values.min()
-        diffs = values - anchor
+        if distance_from == 'min':
+            if open_interval:
+                return [(-np.inf, value) for value in unique_values]
+            return [(value, value) for value in unique_values]
         if distance_from == 'max':
-            anchor = values.max()
-            diffs = anchor - values
+            if open_interval:
+                return [(value, np.inf) for value in unique_values[::-1]]
+            return [(value, value) for value in unique_values[::-1]]
         if distance_from == 'mean':
-            anchor = values.mean()
-            diffs = abs(anchor - values)
-
-        sdiffs = np.unique(diffs)
-        sdiffs.sort()
-        results = []
-      
-        for ix, el in enumerate(sdiffs):
-            mask = diffs <= el
-            vals = values[mask]
-            if False:
-                # when vagueness has been made precise through an ordinal
-                results.append(IntervalCell(vals.min(), vals.max()))
-            elif distance_from == 'max':
-                if open_interval:
-                    results.append(IntervalCell(vals.min(), np.inf))
-                else:
-                    results.append(IntervalCell(vals.min(), vals.min()))
-            elif distance_from == 'min':
-                if open_interval:
-                    results.append(IntervalCell(-np.inf, vals.max()))
-                else:
-                    results.append(IntervalCell(vals.max(), vals.max()))
-            elif distance_from == 'mean':
-                if ix+1 == len(sdiffs): continue  # skip last
-                results.append(IntervalCell(vals.min(), vals.max()))
-        return results 
+            # widen the interval around the mean one distance at a time
+            diffs = abs(values.mean() - unique_values)
+            order = np.argsort(diffs, kind='mergesort')
+            results = []
+            low, high = np.inf, -np.inf
+            for ix, i in enumerate(order):
+                low = min(low, unique_values[i])
+                high = max(high, unique_values[i])
+                if ix+1 < len(order) and diffs[order[ix+1]] == diffs[i]:
+                    continue  # same distance
+                results.append((low, high))
+            return results[:-1]  # skip last
+        return []
 
     def get_paths_for_attribute_set(self, keys):
         """
@@ -250,23 +308,40 @@ class BeliefState(DictCell):
         if not isinstance(keys, (list, set)):
             keys = [keys]
 
-        has_all_keys = lambda name, structure: \
-                all(map(lambda k: k in structure, keys))
-        return self.find_path(has_all_keys, on_targets=True)
+        if not all(isinstance(k, basestring) for k in keys):
+            # only attribute names are indexed
+            has_all_keys = lambda name, structure: \
+                    all(map(lambda k: k in structure, keys))
+            return self.find_path(has_all_keys, on_targets=True)
+        assert self.has_referential_domain(), "need context set"
+        schema = self.get_target_schema()
+        if schema is None:
+            return []
+        return [['target'] + list(path) for path in \
+                reversed(schema.paths_for_attribute_set(keys))]
 
     def get_parts(self):
         """
         Searches for all DictCells (with nested structure)
         """
-        return self.find_path(lambda x: isinstance(x[1], DictCell), on_targets=True)
+        assert self.has_referential_domain(), "need context set"
+        schema = self.get_target_schema()
+        if schema is None:
+            return []
+        return [['target'] + list(path) for path in reversed(schema.parts)]
 
     def get_paths_for_attribute(self, attribute_name):
         """
         Returns a path list to all attributes that have with a particular name.
         """
-        has_name = lambda name, structure:  name == attribute_name
-        return self.find_path(has_name, on_targets=True)
+        assert self.has_referential_domain(), "need context set"
+        schema = self.get_target_schema()
+        if schema is None:
+            return []
+        return [['target'] + list(path) for path in \
+                reversed(schema.paths_for_attribute(attribute_name))]
 
+    @trailed
     def merge(self, keypath, value, op='set'):
         """
         First gets the cell at BeliefState's keypath, or creates a new cell 
@@ -281,7 +356,11 @@ class BeliefState(DictCell):
             negated = self.get_environment_variable('negated', pop=False, default=False)
             if negated:
                 keypath[0] = "distractor"
+        return self._merge_at(keypath, value, op)
 
+    def _merge_at(self, keypath, value, op):
+        """ Merges `value` into the cell at `keypath`, after negation has been
+        applied, creating the cell from the first target that has it """
         if keypath not in self:
             first_referent = None
             if keypath[0] in ['target', 'distractor']:
@@ -308,35 +387,238 @@ class BeliefState(DictCell):
                 raise Exception("Could not find Keypath %s" % (str(keypath)))
 
         # break down keypaths into 
-        cell = self
         if not isinstance(keypath, list):
             keypath = [keypath]
-        for key in keypath:
-            cell = cell[key]
+        cell = self._writable_cell(keypath)
         # perform operation (set, <=, >= etc)
         try:
             return getattr(cell, op)(value)
         except Contradiction as ctrd:
             # add more information to the contradiction
             raise Contradiction("Could not merge %s with %s: %s " % (str(keypath), str(value), ctrd))
+        finally:
+            self._changed(keypath)
    
+    @trailed
+    def merge_many(self, merges):
+        """
+        Applies a batch of merges, given as (keypath, value, op) or (keypath,
+        value) tuples, as a single transaction: either all of them succeed, or
+        the beliefstate is left unchanged and the exception is raised.
+
+        The 'negated' environment variable is looked up once, and the cells that
+        are missing are discovered in one pass over the singleton referents,
+        before the batch is applied (so from the targets the beliefstate had
+        before the batch).  Entity masks are only recomputed on demand after
+        the batch.  Returns the list of the merges' results.
+        """
+        owned = self.__dict__['owned']
+        # the merges are applied to a copy, which is adopted if they succeed
+        scratch = self.copy(copy_on_write=True)
+        try:
+            negated = scratch.get_environment_variable('negated', pop=False, default=False)
+            batch = []
+            missing = {}
+            for merge in merges:
+                keypath, value = merge[:2]
+                op = merge[2] if len(merge) > 2 else 'set'
+                keypath = keypath[:] if isinstance(keypath, list) else [keypath]
+                if keypath[0] == 'target' and negated:
+                    keypath[0] = "distractor"
+                if keypath[0] in ['target', 'distractor'] and keypath not in scratch:
+                    missing[tuple(keypath[1:])] = None
+                batch.append((keypath, value, op))
+
+            if missing:
+                undiscovered = set(missing)
+                for _, referent in scratch.iter_singleton_referents():
+                    for path in [path for path in undiscovered if list(path) in referent]:
+                        missing[path] = referent
+                        undiscovered.remove(path)
+                    if not undiscovered:
+                        break
+
+            results = []
+            for keypath, value, op in batch:
+                referent = missing.get(tuple(keypath[1:]))
+                if referent is not None and keypath not in scratch:
+                    cell = referent.get_value_from_path(keypath[1:]).stem()
+                    scratch.add_cell(keypath, cell)
+                # cells that were not discovered raise as in merge()
+                results.append(scratch._merge_at(keypath, value, op))
+        except:
+            # the beliefstate again owns all the parts it shared with the copy
+            self.__dict__['owned'] = owned
+            raise
+        trail = self.__dict__['trail']
+        self._dirty()
+        self.__dict__.update(scratch.__dict__)
+        self.__dict__['trail'] = trail
+        self._adopt_parts()
+        if owned is None:
+            # the copy is discarded, so nothing is shared
+            self.__dict__['owned'] = None
+        else:
+            owned = owned.copy()
+            owned.update(scratch.__dict__['owned'])
+            self.__dict__['owned'] = owned
+        return results
+
+    @trailed
     def add_cell(self, keypath, cell):
         """ Adds a new cell to the end of `keypath` of type `cell`"""
         keypath = keypath[:] # copy
         inner = self  # the most inner dict where cell is added
         cellname = keypath  # the name of the cell
         assert keypath not in self, "Already exists: %s " % (str(keypath))
+        keypath_added = keypath[:] if isinstance(keypath, list) else [keypath]
         if isinstance(keypath, list):
             while len(keypath) > 1:
                 cellname = keypath.pop(0)
+                inner._dirty()
                 if cellname not in inner:
-                    inner.__dict__['p'][cellname] = DictCell()
-                inner = inner[cellname] # move in one
+                    inner.__dict__['p'][cellname] = inner._adopt(self._own(DictCell()))
+                inner = self._writable_part(inner, cellname) # move in one
             cellname = keypath[0]
         # now we can add 'cellname'->(Cell) to inner (DictCell)
-        inner.__dict__['p'][cellname] = cell
+        inner._dirty()
+        inner.__dict__['p'][cellname] = inner._adopt(self._own(cell))
+        self._changed(keypath_added)
         return inner[cellname]
 
+    def checkpoint(self):
+        """
+        Opens a checkpoint and returns its mark.  Until the checkpoint is closed,
+        by `rollback(mark)` or `commit(mark)`, the cells that are changed through
+        the beliefstate's methods are recorded in its trail, so that
+        `rollback(mark)` can undo their changes in O(changes).
+        Checkpoints can be nested.
+        """
+        if self.__dict__['trail'] is None:
+            self.__dict__['trail'] = Trail()
+        return self.__dict__['trail'].checkpoint()
+
+    def rollback(self, mark):
+        """ Undoes all changes made since `checkpoint()` returned `mark`, and
+        closes that checkpoint """
+        self.__dict__['trail'].rollback(mark)
+
+    def commit(self, mark):
+        """ Keeps the changes made since `checkpoint()` returned `mark`, and
+        closes that checkpoint """
+        self.__dict__['trail'].commit(mark)
+
+    def in_checkpoint(self):
+        """ Whether a checkpoint is open """
+        trail = self.__dict__['trail']
+        return trail is not None and trail.is_open()
+
+    def _snapshot(self):
+        """ Returns the state of the beliefstate, for `_restore()` """
+        state = DictCell._snapshot(self)
+        del state['trail']
+        state['deferred_effects'] = state['deferred_effects'].copy()
+        return state
+
+    def _restore(self, state):
+        """ Restores a state returned by `_snapshot()`, keeping the trail """
+        trail = self.__dict__['trail']
+        DictCell._restore(self, state)
+        self.__dict__['trail'] = trail
+
+    def _own(self, cell):
+        """ Records that `cell` is not shared with other beliefstates """
+        if self.__dict__['owned'] is not None:
+            self.__dict__['owned'][id(cell)] = cell
+        return cell
+
+    def _writable_part(self, parent, key, deep=False):
+        """
+        Returns the part `key` of the DictCell `parent` for changing it in place.
+        After a copy-on-write `copy()`, a part that may be shared with other
+        beliefstates is first replaced by a clone: a deep copy if `deep`, and
+        otherwise a DictCell that shares its own parts.
+        """
+        cell = parent.__dict__['p'][key]
+        owned = self.__dict__['owned']
+        if owned is None or id(cell) in owned:
+            return cell
+        if deep or not isinstance(cell, DictCell):
+            clone = copy.deepcopy(cell)
+        else:
+            clone = cell.__class__.__new__(cell.__class__)
+            clone.__dict__.update(cell.__dict__)
+            clone.__dict__.pop('_parents', None)
+            clone.__dict__['p'] = cell.__dict__['p'].copy()
+            clone._adopt_parts()
+        parent.__dict__['p'][key] = parent._adopt(self._own(clone))
+        return clone
+
+    def _writable_cell(self, keypath):
+        """ Returns the cell at `keypath` for changing it in place, cloning the
+        shared DictCells along the keypath (see `_writable_part`) and dropping
+        their cached hashes """
+        cell = self
+        for i, key in enumerate(keypath):
+            cell._dirty()
+            cell = self._writable_part(cell, key, deep=(i == len(keypath)-1))
+        return cell
+
+    @trailed
+    def __setattr__(self, k, v):
+        """ Merges or creates a new top-level property (see DictCell) """
+        if k in self.__dict__['p']:
+            self._writable_part(self, k, deep=True)
+        result = DictCell.__setattr__(self, k, v)
+        self._changed([k])
+        return result
+
+    @trailed
+    def __setitem__(self, k, val):
+        """ Merges a top-level property (see DictCell) """
+        if k in self.__dict__['p']:
+            self._writable_part(self, k, deep=True)
+        result = DictCell.__setitem__(self, k, val)
+        self._changed([k])
+        return result
+
+    def _changed(self, keypath):
+        """
+        Invalidates the state that is derived from the cell at `keypath` after
+        it has been changed.  Only the entity bitmap of the changed part of
+        'target' or 'distractor' is dropped, and is recomputed on demand.
+        """
+        side = keypath[0]
+        if side in ['target', 'distractor']:
+            masks = self.__dict__['singleton_masks']
+            if len(keypath) == 1:
+                for part in [part for part in masks if part[0] == side]:
+                    del masks[part]
+            else:
+                masks.pop(tuple(keypath[:2]), None)
+            self.__dict__['singleton_mask'] = None
+
+    def _invalidate(self, path):
+        """
+        Also invalidates the state derived from the part of 'target' or
+        'distractor' that contains the changed cell (see `_changed`), however
+        it was changed.  A part that was replaced, rather than changed, is
+        told apart by `_side_bitmap`.
+        """
+        DictCell._invalidate(self, path)
+        top = path[1]
+        if top is None:
+            return
+        for side in ['target', 'distractor']:
+            if self.__dict__['p'].get(side) is top[0]:
+                if top[1] is None:
+                    # its parts may have been added, removed or replaced
+                    self.__dict__['singleton_mask'] = None
+                else:
+                    for key, cell in top[0].__dict__['p'].iteritems():
+                        if cell is top[1][0]:
+                            self._changed([side, key])
+
     def entails(self, other):
         """
         One beliefstate entails another beliefstate iff the other state's entities are
@@ -399,26 +681,39 @@ class BeliefState(DictCell):
                 return True 
         return False 
 
+    @persistent('target', 'distractor', 'targetset_arity', 'contrast_arity')
     def size(self):
         """ Returns the size of the belief state.
 
         Initially if there are $n$ consistent members, (the result of `self.number_of_singleton_referents()`) 
         then there are generally $2^{n}-1$ valid belief states.
+
+        The size is computed in closed form, as the sum of $\binom{n}{k}$ over the
+        target set arities $k$ allowed by `target_arity_range()`, so the target sets
+        are never enumerated.
         """
-        n = self.number_of_singleton_referents()
-        targets = list(self.iter_referents_tuples())
-        n_targets = len(targets)
-        if n == 0 or n_targets == 0:
-            return  0
+        n = self._count_singleton_referents()
+        low, high = self.target_arity_range(n)
+        return binomial_range(n, low, high)
 
-        #if len(self.__dict__['deferred_effects']) != 0:
-        #    return -1 
-        size1 = len(list(self.iter_referents_tuples()))
+    def target_arity_range(self, n=None):
+        """
+        Returns the (low, high) inclusive range of target set sizes that are
+        consistent with both 'targetset_arity' and 'contrast_arity' when there
+        are `n` compatible singletons (by default, `self.number_of_singleton_referents()`).
+
+        Every target set has a size of at least 1, and its contrast set (the
+        remaining singletons) has a size of `n` minus its size.  The range is empty
+        when low > high.
+        """
+        if n is None:
+            n = self.number_of_singleton_referents()
         tlow, thigh = self['targetset_arity'].get_tuple()
         clow, chigh = self['contrast_arity'].get_tuple()
-        return size1
-        #size2 = binomial_range(n, max(tlow,1), min([n-max(clow,0),thigh,n]))
-        #assert size1 == size2, "%i != %i" % (size1, size2)
+        # clipping to [1, n] removes the infinite bounds
+        low = max(1, tlow, n - chigh)
+        high = min(n, thigh, n - clow)
+        return int(np.ceil(low)), int(np.floor(high))
 
     def referents(self):
         """ Returns all target sets that are compatible with the current beliefstate.
@@ -428,35 +723,95 @@ class BeliefState(DictCell):
         # all groupings of singletons
         return list(self.iter_referents())
     
-    def iter_referents(self):
-        """ Generates target sets that are compatible with the current beliefstate. """
-        tlow, thigh = self['targetset_arity'].get_tuple()
-        clow, chigh = self['contrast_arity'].get_tuple()
+    def referent_at(self, i):
+        """ Returns the `i`-th target set, the same as `self.referents()[i]`, by
+        unranking it directly rather than enumerating the target sets before it."""
+        singletons = self.singleton_indices()
+        n = len(singletons)
+        low, high = self.target_arity_range(n)
+        if i < 0:
+            i += binomial_range(n, low, high)
+        if i >= 0:
+            for r, count in self._iter_arity_counts(n):
+                if i < count:
+                    return tuple(self.singleton_referent(singletons[j]) \
+                            for j in unrank_combination(n, r, i))
+                i -= count
+        raise IndexError("Target set index out of range")
+
+    def sample_referents(self, k=1, seed=None):
+        """ Draws `k` target sets uniformly at random (with replacement) from the
+        target sets that are compatible with the current beliefstate, without
+        enumerating them.
 
-        referents = list(self.iter_singleton_referents())
-        t = len(referents)
-        low = max(1, tlow)
-        high = min([t,  thigh])
+        Each draw picks an arity with probability proportional to its number of
+        target sets, then a uniformly random subset of the singletons with that
+        arity.  `seed` is passed to `random.Random`.
+        """
+        singletons = self.singleton_indices()
+        n = len(singletons)
+        counts = list(self._iter_arity_counts(n))
+        total = sum(count for _, count in counts)
+        if total == 0:
+            return []
+        rng = random.Random(seed)
+        samples = []
+        for _ in xrange(k):
+            i = rng.randrange(total)
+            for r, count in counts:
+                if i < count:
+                    break
+                i -= count
+            positions = sorted(rng.sample(xrange(n), r))
+            samples.append(tuple(self.singleton_referent(singletons[j]) for j in positions))
+        return samples
 
-        for targets in itertools.chain.from_iterable(itertools.combinations(referents, r) \
-            for r in reversed(xrange(low, high+1))):
-            if clow <= t-len(targets) <= chigh:
-                yield  targets
+    def iter_referents(self, offset=0, limit=None):
+        """ Generates target sets that are compatible with the current beliefstate,
+        skipping the first `offset` target sets and stopping after `limit` of them."""
+        singletons = self.singleton_indices()
+        referents = {}  # rebuilt only once, and only if they are in a target set
+        for positions in self._iter_target_positions(len(singletons), offset, limit):
+            for j in positions:
+                if j not in referents:
+                    referents[j] = self.singleton_referent(singletons[j])
+            yield tuple(referents[j] for j in positions)
 
-    def iter_referents_tuples(self):
+    def iter_referents_tuples(self, offset=0, limit=None):
         """ Generates target sets (as tuples of indicies) that are compatible with
-        the current beliefstate."""
-        tlow, thigh = self['targetset_arity'].get_tuple()
-        clow, chigh = self['contrast_arity'].get_tuple()
-        singletons = list([int(i) for i,_ in self.iter_singleton_referents()])
-        t = len(singletons)
-        low = int(max(1, tlow))
-        high = int(min([t,  thigh]))
-        for elements in itertools.chain.from_iterable(itertools.combinations(singletons, r) \
-                for r in reversed(xrange(low, high+1))):
-            if clow <= t-len(elements) <= chigh:
-                yield  elements
+        the current beliefstate, skipping the first `offset` target sets and stopping
+        after `limit` of them."""
+        singletons = self.singleton_indices()
+        for positions in self._iter_target_positions(len(singletons), offset, limit):
+            yield tuple(singletons[j] for j in positions)
+
+    def _iter_arity_counts(self, n):
+        """ Generates (arity, number of target sets) pairs from the largest to
+        the smallest target set arity, for `n` compatible singletons. """
+        low, high = self.target_arity_range(n)
+        if low > high:
+            return
+        count = choose(n, high)
+        for r in xrange(high, low-1, -1):
+            yield r, count
+            count = count * r // (n - r + 1)  # C(n, r-1)
+
+    def _iter_target_positions(self, n, offset=0, limit=None):
+        """ Generates target sets as tuples of positions in range(n), largest
+        arity first, jumping straight to the `offset`-th target set using the
+        combinatorial number system. """
+        def positions():
+            start = offset
+            for r, count in self._iter_arity_counts(n):
+                if start >= count:
+                    start -= count
+                    continue
+                for combination in iter_combinations(n, r, start):
+                    yield combination
+                start = 0
+        return itertools.islice(positions(), limit)
 
+    @persistent('target', 'distractor')
     def number_of_singleton_referents(self):
         """
         Returns the number of singleton elements of the referential domain that are
@@ -464,39 +819,96 @@ class BeliefState(DictCell):
 
         This is the size of the union of all referent sets.
         """
+        return self._count_singleton_referents()
+
+    def _count_singleton_referents(self):
+        """ `number_of_singleton_referents()`, without the result cache """
         if self.__dict__['referential_domain']:
-            ct = 0
-            for i in self.iter_singleton_referents():
-                ct += 1
-            return ct
+            return int(self.get_singleton_mask().sum())
         else:
             raise Exception("self.referential_domain must be defined")
 
+    def get_domain_columns(self):
+        """
+        Returns the columnar mirror (a ColumnarDomain) of the referential domain,
+        which is built once and shared with copies of the beliefstate.
+        """
+        columns = self.__dict__['domain_columns']
+        if columns is None:
+            if not self.has_referential_domain():
+                raise Exception("No referential_domain defined")
+            columns = ColumnarDomain.for_domain(self.__dict__['referential_domain'])
+            self.__dict__['domain_columns'] = columns
+        return columns
+
+    def get_singleton_mask(self):
+        """
+        Returns a boolean mask over the entities of the referential domain, which
+        is True for the entities that are entailed by 'target' and, if there is a
+        'distractor', are not entailed by it.
+
+        The mask is the conjunction of one bitmap per part of 'target' (and the
+        difference with those of 'distractor'), each testing all of the entities
+        at once through the domain's columns and their inverted indexes.  The
+        part bitmaps are kept across calls, and changing a cell of 'target' or
+        'distractor' (see `_invalidate`) only invalidates the bitmap of the part
+        that contains it.  The returned mask must not be modified.
+        """
+        mask = self.__dict__['singleton_mask']
+        if mask is None:
+            bitmap = self._side_bitmap('target')
+            if not self['distractor'].empty():
+                bitmap &= ~self._side_bitmap('distractor')
+            mask = unpack(bitmap, self.get_domain_columns().size)
+            self.__dict__['singleton_mask'] = mask
+        return mask
+
+    def _side_bitmap(self, side):
+        """ Returns the bitmap of entities entailed by the parts of `side`
+        ('target' or 'distractor'), computing only the missing part bitmaps """
+        columns = self.get_domain_columns()
+        masks = self.__dict__['singleton_masks']
+        bitmap = np.empty((columns.size + 7) // 8, dtype=np.uint8)
+        bitmap.fill(0xff)
+        for key, cell in self[side].__dict__['p'].iteritems():
+            part = (side, key)
+            entry = masks.get(part)
+            if entry is None or entry[0] is not cell:
+                # a part that was replaced by another cell has a new bitmap
+                entry = masks[part] = (cell, columns.part_bitmap((key,), cell))
+            bitmap &= entry[1]
+        return bitmap
+
     def iter_singleton_referents(self):
         """
         Iterator of all of the singleton members of the context set.
 
-        NOTE: this evaluates entities one-at-a-time, and does not handle relational constraints.
+        NOTE: this evaluates entities independently of each other (all at once,
+        through the domain's columns), and does not handle relational constraints.
         """
-        try:
-            for member in self.__dict__['referential_domain'].iter_entities():
-                if self['target'].is_entailed_by(member) and (self['distractor'].empty() or not self['distractor'].is_entailed_by(member)):
-                    yield member['num'], member
-        except KeyError:
-            raise Exception("No referential_domain defined")
+        for i in self.singleton_indices():
+            yield self.singleton_referent(i)
 
     def iter_singleton_referents_tuples(self):
         """
         Iterator of all of the singleton members's id number of the context set.
 
-        NOTE: this evaluates entities one-at-a-time, and does not handle relational constraints.
+        NOTE: this evaluates entities independently of each other, and does not
+        handle relational constraints.
         """
-        try:
-            for member in self.__dict__['referential_domain'].iter_entities():
-                if self['target'].is_entailed_by(member) and (self['distractor'].empty() or not self['distractor'].is_entailed_by(member)):
-                    yield member['num'].low
-        except KeyError:
-            raise Exception("No referential_domain defined")
+        return iter(self.singleton_indices())
+
+    def singleton_indices(self):
+        """ Returns the list of the id numbers of the singleton members of the
+        context set, which are their positions in the referential domain, so
+        (unlike `iter_singleton_referents`) it does not rebuild the entities of
+        a MappedDomain """
+        return np.flatnonzero(self.get_singleton_mask()).tolist()
+
+    def singleton_referent(self, i):
+        """ Returns the (num, entity) pair of entity `i` of the referential domain """
+        member = self.get_domain_columns().entities[i]
+        return member['num'], member
             
     def to_latex(self, number=0):
         """ Returns a raw text string that contains a latex representation of
@@ -512,22 +924,77 @@ class BeliefState(DictCell):
         return latex
 
     
-    def copy(self):
+    def copy(self, copy_on_write=False):
         """
         Copies the BeliefState by recursively deep-copying all of
         its parts.  Domains are not copied, as they do not change
         during the interpretation or generation.
+
+        With `copy_on_write`, the copy instead shares all of its parts with the
+        caller.  Afterwards, either beliefstate clones a shared part only when
+        it changes it, along the keypath that `merge()` or `add_cell()` changes,
+        so parts must only be changed through those methods.  While a checkpoint
+        is open, copies are always deep copies, because rolling back restores
+        the changed cells in place.
         """
-        copied = BeliefState(self.__dict__['referential_domain']) 
-        for key in ['environment_variables', 'deferred_effects', 'pos', 'p']:
-            copied.__dict__[key] = copy.deepcopy(self.__dict__[key])
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.__dict__['trail'] = None
+        memo = {}
+        if copy_on_write and not self.in_checkpoint():
+            copied.__dict__['p'] = self.__dict__['p'].copy()
+            copied.__dict__['environment_variables'] = self.__dict__['environment_variables'].copy()
+            copied.__dict__['deferred_effects'] = self.__dict__['deferred_effects'].copy()
+            # neither beliefstate owns the parts that they now share
+            self.__dict__['owned'] = {}
+            copied.__dict__['owned'] = {}
+        else:
+            for key in ['environment_variables', 'deferred_effects', 'p']:
+                copied.__dict__[key] = copy.deepcopy(self.__dict__[key], memo)
+            copied.__dict__['owned'] = None
+        copied._adopt_parts()
+        # masks are replaced, not modified, so they can be shared, along with
+        # the copies of the cells they were computed from
+        masks = copied.__dict__['singleton_masks'] = {}
+        for part, (cell, bitmap) in self.__dict__['singleton_masks'].iteritems():
+            masks[part] = (memo.get(id(cell), cell), bitmap)
         return copied
 
+    # recomputed after unpickling, rather than pickled
+    DERIVED = ('domain_columns', 'singleton_masks', 'singleton_mask',
+               'order_statistics', 'owned', 'trail')
+
+    SHARED = ('referential_domain',)
+
+    def __setstate__(self, state):
+        """ Restores a pickled beliefstate, which owns all of its parts """
+        DictCell.__setstate__(self, state)
+        self.__dict__.update({'domain_columns': None, 'singleton_masks': {},
+            'singleton_mask': None, 'order_statistics': None, 'owned': None,
+            'trail': None})
+
+    def _fingerprint_state(self):
+        """
+        The content that `fingerprint()` digests: what `__hash__` hashes, and
+        the referential domain, which is identified by the fingerprint of its
+        entities rather than by its key in this process's registry.
+        """
+        if self.has_referential_domain():
+            domain = self.get_domain_columns().fingerprint()
+        else:
+            domain = None
+        return (self.__dict__['pos'], self.__dict__['environment_variables'],
+                list(self.__dict__['deferred_effects']), domain, self.__dict__['p'])
+
+    @cached_hash
     def __hash__(self):
         """
         This is the all-important hash method that recursively computes a hash
         value from the components of the beliefstate.  The search process treats
         two beliefstates as equal if their hash values are the same.
+
+        The value is cached, as are the hashes of its cells, and only the cells
+        along the keypaths that were changed since are hashed again.
         """
         hashval = 0
 
@@ -0,0 +1,215 @@
+"""
+A persistent cache of the results that BeliefState derives from its
+referential domain (`size()`, `number_of_singleton_referents()` and the
+ordered values of `get_ordered_values()`), so that jobs that interpret the
+same utterances against the same referential domains do not recompute them:
+
+    >> BeliefState.result_cache = ResultCache('/var/cache/beliefs.sqlite')
+    >> belief.size()   # computed, and stored
+    >> ...
+    >> belief.size()   # in this or a later process: read from the cache
+
+Results are keyed by the fingerprints (see Cell.fingerprint) of the parts of
+the beliefstate that they depend on and of the entities of its referential
+domain, plus the domain's `version` attribute, if it has one, which
+invalidates the results computed with an earlier version of the domain.
+Changing any cell of the beliefstate, even a nested one directly, discards the
+cached fingerprints of the cells that contain it (see Cell._invalidate), so the
+results of a changed beliefstate are never looked up under its earlier key.
+
+The cache is stored with sqlite3, which several processes (e.g. the workers of
+a ParallelSearch) may share: every store is committed at once, so that no
+process holds the database locked, and lookups only read it.  When the cache
+holds more than `capacity` results the least recently used ones are evicted;
+results are marked as used with timestamps, which every process compares
+alike, and the marks of the results that were looked up are written with the
+next store (or by `flush()`).
+"""
+import cPickle as pickle
+import os
+import sqlite3
+import time
+from beliefs.cells import fingerprint as fingerprints
+
+
+def persistent(*parts):
+    """
+    Decorates a BeliefState method whose result depends only on the `parts`
+    of the beliefstate (the names of its top-level cells), its referential
+    domain and the arguments, so that it is looked up in (and stored to)
+    `BeliefState.result_cache`, if one is set.
+    """
+    def decorate(method):
+        def cached_method(self, *args):
+            cache = self.result_cache
+            if cache is None:
+                return method(self, *args)
+            key = cache.key(self, method.__name__, args, parts)
+            found, result = cache.get(key)
+            if not found:
+                result = method(self, *args)
+                cache.put(key, result)
+            return result
+        cached_method.__name__ = method.__name__
+        cached_method.__doc__ = method.__doc__
+        cached_method.parts = parts
+        return cached_method
+    return decorate
+
+
+class ResultCache(object):
+    """
+    A bounded, persistent table of pickled results.  Every process connects to
+    the database file on its own (forked processes reconnect).  Stores are
+    committed at once; the marks of up to `commit_every` used results are
+    kept until then.
+    """
+
+    def __init__(self, path, capacity=1000000, commit_every=100):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.path = path
+        self.capacity = capacity
+        self.commit_every = commit_every
+        self.connection = None
+        self.pid = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        """ Returns the connection of this process to the database """
+        if self.connection is None or self.pid != os.getpid():
+            # other processes hold the database only while they store a result
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.pid = os.getpid()
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results "
+                    "(key TEXT PRIMARY KEY, result BLOB, used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            self.connection.commit()
+            self.entries = self.connection.execute(
+                    "SELECT COUNT(*) FROM results").fetchone()[0]
+            self.used = {}  # key -> time it was last looked up, not yet written
+        return self.connection
+
+    def key(self, state, name, args=(), parts=None):
+        """ Returns the key of the result of `state.name(*args)`, which depends
+        on the top-level cells of `state` named by `parts` (by default, on all
+        of `state`) """
+        domain = state.__dict__['referential_domain']
+        version = getattr(domain, 'version', None)
+        if parts is None:
+            return fingerprints.fingerprint(state.fingerprint(), version, name, args)
+        if state.has_referential_domain():
+            domain = state.get_domain_columns().fingerprint()
+        cells = state.__dict__['p']
+        return fingerprints.fingerprint(domain, version, name, args,
+                [(part, cells[part].fingerprint() if part in cells else None) for part in parts])
+
+    def get(self, key):
+        """
+        Returns (True, result) if a result is stored for `key` (marking it as
+        recently used), and otherwise (False, None).  Counts towards the hit
+        rate.
+        """
+        connection = self.connect()
+        row = connection.execute("SELECT result FROM results WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.used[key] = time.time()
+        if len(self.used) >= self.commit_every:
+            self.flush()
+        return True, pickle.loads(str(row[0]))
+
+    def put(self, key, result):
+        """ Stores `result` for `key`, evicting the least recently used results
+        if the cache is full, and commits it """
+        connection = self.connect()
+        blob = sqlite3.Binary(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        self.used.pop(key, None)
+        try:
+            self._write_used()
+            cursor = connection.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?)",
+                    (key, blob, time.time()))
+            if cursor.rowcount == 0:
+                connection.execute("UPDATE results SET result = ?, used = ? WHERE key = ?",
+                        (blob, time.time(), key))
+            else:
+                self.entries += 1
+                if self.entries > self.capacity:
+                    self.evict()
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    def evict(self):
+        """ Removes the least recently used results, down to 90% of the
+        capacity, so that evictions are amortized over many stores """
+        # other processes may have stored results too
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        excess = self.entries - int(self.capacity * 0.9)
+        if self.entries <= self.capacity:
+            return
+        self.connection.execute("DELETE FROM results WHERE key IN "
+                "(SELECT key FROM results ORDER BY used LIMIT ?)", (excess,))
+        self.entries -= excess
+        self.evictions += excess
+
+    def _write_used(self):
+        """ Marks the results that were looked up as used, in the current
+        transaction """
+        if self.used:
+            self.connection.executemany("UPDATE results SET used = ? WHERE key = ?",
+                    [(used, key) for key, used in self.used.iteritems()])
+            self.used = {}
+
+    def flush(self):
+        """ Writes the marks of the results that were looked up """
+        if self.connection is not None and self.pid == os.getpid() and self.used:
+            try:
+                self._write_used()
+                self.connection.commit()
+            except Exception:
+                self.connection.rollback()
+                raise
+
+    def close(self):
+        """ Writes the marks of the used results and closes the connection """
+        self.flush()
+        if self.connection is not None and self.pid == os.getpid():
+            self.connection.close()
+        self.connection = None
+
+    def hit_rate(self):
+        """ Returns the fraction of lookups that found a stored result """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """ Returns the cache's instrumentation counters """
+        self.connect()
+        return {'entries': self.entries,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate(),
+                'evictions': self.evictions}
+
+    def clear(self):
+        """ Removes all results, but keeps the counters """
+        self.connect().execute("DELETE FROM results")
+        self.connection.commit()
+        self.entries = 0
+        self.used = {}
+
+    def __len__(self):
+        self.connect()
+        return self.entries
@@ -12,6 +12,8 @@ from lists import *
 from strings import *
 from posets import *
 from dicts import *
+from trail import Trail, trailed
+from taxonomy import CompiledTaxonomy
 
 # special cells
 from colors import *
@@ -1,5 +1,6 @@
 from beliefs.cells import *
 from .exceptions import *
+from .cell import cached_hash
 
 # constants for 3-valued logic
 T = True
@@ -12,6 +13,8 @@ class BoolCell(Cell):
     3-valued logic (T, F, U)
     (U)ndefined means (T v F) ^ -(T ^ F)
     """
+    PACKED = ('value',)
+
     def __init__(self, value=None):
         """ Initializes a new BoolCell, default to 'U' """
         if not value in [T, F]:
@@ -112,6 +115,7 @@ class BoolCell(Cell):
     def __repr__(self):
         return "%r" % (self.value,)
 
+    @cached_hash
     def __hash__(self):
         """
         Returns a hash that is different for T, F and U
@@ -48,8 +48,27 @@ to allow values to come from multiple sources.
 
 import copy
 import logging
+import weakref
 from beliefs.belief_utils import *
 from .exceptions import *
+from . import fingerprint as fingerprints
+from . import registry
+
+def cached_hash(compute_hash):
+    """
+    Decorates a Cell's __hash__ method so the computed value is cached in the
+    cell until the cell, or a cell that it contains, changes (see
+    `Cell._dirty`).
+    """
+    def __hash__(self):
+        hval = self.__dict__.get('_hash')
+        if hval is None:
+            hval = compute_hash(self)
+            self.__dict__['_hash'] = hval
+        return hval
+    __hash__.__doc__ = compute_hash.__doc__
+    return __hash__
+
 
 class Cell(object):
     """
@@ -76,6 +95,12 @@ class Cell(object):
         * coerce(value)
 
     """
+    trail = None  # the active Trail, which records changes (see trail.py)
+    PACKED = ()   # attributes that are pickled as a tuple (see __getstate__)
+    DERIVED = ()  # attributes that are recomputed rather than pickled
+    SHARED = ()   # attributes whose (unchanging) values many cells share, which
+                  # are pickled with their key in the registry (see registry.py)
+
     def __instancecheck__(self, obj):
         """
         defines behavior of isinstance(obj, Cell) that checks to see
@@ -91,6 +116,101 @@ class Cell(object):
         return True
             
 
+    def __setattr__(self, name, value):
+        """ Setting an attribute changes the cell, which drops its cached hash
+        and fingerprint (and those of the cells that contain it) """
+        if Cell.trail is not None:
+            Cell.trail.record(self)
+        self._invalidate((self, None))
+        object.__setattr__(self, name, value)
+
+    def _dirty(self):
+        """ Drops the cached hash and fingerprint before the cell is changed in
+        place, along with those of the cells that contain it, and records the
+        cell in the active trail """
+        if Cell.trail is not None:
+            Cell.trail.record(self)
+        self._invalidate((self, None))
+
+    def _invalidate(self, path):
+        """
+        Drops the cached hash and fingerprint of the cell, which is or contains
+        a changed cell, and those of the cells that contain it.  `path` is the
+        chain of cells from this one down to the changed one, as nested pairs:
+        (cell, (part, ... (changed cell, None))).
+        """
+        self.__dict__['_hash'] = None
+        self.__dict__['_fingerprint'] = None
+        parents = self.__dict__.get('_parents')
+        if parents:
+            for key, ref in parents.items():
+                parent = ref()
+                if parent is None:
+                    del parents[key]
+                else:
+                    parent._invalidate((parent, path))
+
+    def _adopt(self, part):
+        """ Records that the cell contains `part`, so that changing `part`
+        invalidates the cell (see `_invalidate`), and returns `part` """
+        if isinstance(part, Cell):
+            # id -> weak reference, so that parts do not keep the cells that
+            # contained them alive
+            parents = part.__dict__.get('_parents')
+            if parents is None:
+                parents = part.__dict__['_parents'] = {}
+            elif len(parents) >= 8 and not len(parents) & (len(parents) - 1):
+                # drop the cells that are gone, at every power of two
+                for key, ref in parents.items():
+                    if ref() is None:
+                        del parents[key]
+            parents[id(self)] = weakref.ref(self)
+        return part
+
+    def _adopt_parts(self):
+        """ Adopts all of the cell's parts, after they were set or copied.  Cells
+        that contain other cells override it. """
+        pass
+
+    def fingerprint(self):
+        """
+        Returns a 128-bit digest (32 hex digits) of the class and content of the
+        cell that, unlike `hash()`, is the same in every process and run.  It is
+        cached until the cell changes, and a cell that has parts includes their
+        fingerprints, so only the parts that changed are fingerprinted again.
+        """
+        fval = self.__dict__.get('_fingerprint')
+        if fval is None:
+            fval = fingerprints.fingerprint(self.__class__.__module__,
+                    self.__class__.__name__, self._fingerprint_state())
+            self.__dict__['_fingerprint'] = fval
+        return fval
+
+    def _fingerprint_state(self):
+        """ Returns the content of the cell that `fingerprint()` digests """
+        return self.__getstate__()
+
+    def _snapshot(self):
+        """ Returns the state of the cell, for `_restore()` """
+        state = self.__dict__.copy()
+        for key, val in state.iteritems():
+            if isinstance(val, (dict, set, list)):
+                state[key] = copy.copy(val)
+        return state
+
+    def _restore(self, state):
+        """ Restores a state returned by `_snapshot()`, which invalidates the
+        cells that contain the cell """
+        parents = self.__dict__.get('_parents')
+        self.__dict__.clear()
+        self.__dict__.update(state)
+        if parents is not None:
+            self.__dict__['_parents'] = parents
+            for ref in parents.values():
+                parent = ref()
+                if parent is not None:
+                    parent._invalidate((parent, (self, None)))
+
     def is_equal(self, other):
         raise NotImplemented 
 
@@ -143,17 +263,65 @@ class Cell(object):
         """
         return self.__repr__()
 
+    def __getstate__(self):
+        """
+        Returns the state that is pickled: the cell's attributes, without its
+        cached hash and fingerprint or DERIVED attributes, and with each value packed by
+        `_pack()`.  If the attributes are exactly the PACKED ones, only their
+        values are pickled, as a tuple.
+        """
+        state = dict((key, self._pack(key, val)) for key, val in self.__dict__.iteritems() \
+                if key not in ('_hash', '_fingerprint', '_parents') and key not in self.DERIVED)
+        if self.PACKED and len(state) == len(self.PACKED) and \
+                all(key in state for key in self.PACKED):
+            return tuple(state[key] for key in self.PACKED)
+        return state
+
+    def __setstate__(self, state):
+        """ Restores a state returned by `__getstate__()` """
+        if isinstance(state, tuple):
+            state = zip(self.PACKED, state)
+        else:
+            state = state.iteritems()
+        for key, val in state:
+            self.__dict__[key] = self._unpack(key, val)
+        self._adopt_parts()
+
+    def _pack(self, key, val):
+        """ Returns the value of attribute `key` as it is pickled """
+        if key in self.SHARED and val is not None:
+            return registry.pack(val, registry.key(val))
+        return val
+
+    def _unpack(self, key, val):
+        """ Inverse of `_pack()`: unpickled cells share the SHARED values """
+        if key in self.SHARED and val is not None:
+            return registry.unpack(val)
+        return val
+
+    def __copy__(self):
+        """ Shallow copies share the values of all attributes, but not the
+        cells that contain them """
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.__dict__.pop('_parents', None)
+        copied._adopt_parts()
+        return copied
+
     def __deepcopy__(self, memo):
         """
         Copies a Cell but does not copy it's domain or values (extension)
         because these can be recomputed.
         TODO: test that amortized flags (__recompute=False) are not copied
         """
-        copied = copy.copy(self)  # shallow copy
-        copied.__dict__.update(self.__dict__)
-        for key, val in copied.__dict__.items():
-            if not key in ['domain', 'values', '_domain_hash']:
+        copied = self.__class__.__new__(self.__class__)
+        memo[id(self)] = copied
+        for key, val in self.__dict__.iteritems():
+            if key in ['domain', 'values', '_domain_hash']:
+                copied.__dict__[key] = val
+            elif key != '_parents':
                 copied.__dict__[key] = copy.deepcopy(val, memo)
+        copied._adopt_parts()
         return copied
 
     def stem(self):
@@ -164,6 +332,7 @@ class Cell(object):
         """ Returns a string containing the class name """
         return str(self.__class__.__name__)
         
+    @cached_hash
     def __hash__(self):
         """
         A general purpose hash method for cells. If cells have other parts
@@ -52,6 +52,7 @@ class RGBColorCell(Cell):
             out += hex(self.g)[2:]
         return out
         
+    @cached_hash
     def __hash__(self):
         """
         Representation of set color
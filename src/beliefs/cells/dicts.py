@@ -13,8 +13,14 @@ class DictCell(Cell):
 
     Unlike the other primitive structures, a DictCell cannot be coerced into something
     else.
+
+    A DictCell caches its hash.  Its parts keep (weak) references to the
+    DictCells that contain them, so changing a part in place, however deeply
+    nested, also drops the cached hashes of the DictCells that contain it (see
+    `Cell._invalidate`).
     """
     HASATTR = 0
+    PACKED = ('p',)
     PRIMES = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41,
           43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97, 101, 103, 107, 109,
           113, 127, 131, 137, 139, 149, 151, 157, 163, 167, 173, 179]
@@ -37,13 +43,15 @@ class DictCell(Cell):
                     raise CellConstructionFailure("Value of property '%s' must be " % (key,) +
                             "an instance of Cell, not %s" % (type(val)))
         self.__dict__['p'] = from_dict
+        self._adopt_parts()
 
     def __setattr__(self, k, v):
         """ Merges or creates a new value for a property in the dictionary """
+        self._dirty()
         if k in self.__dict__['p']:
             return self[k].merge(v)
         else:
-            self.__dict__['p'][k] = v
+            self.__dict__['p'][k] = self._adopt(v)
             return self[k]
 
     def __getitem__(self, k):
@@ -63,6 +71,7 @@ class DictCell(Cell):
         set property `size` to value 3, you would call: `d['size']` = 3 """
         if not hasattr(self, 'p'):
             raise AttributeError("No property attribute 'p'")
+        self._dirty()
         if k in self.__dict__['p']:
             return self.p[k].merge(val)
         else:
@@ -73,6 +82,7 @@ class DictCell(Cell):
         if not hasattr(self, 'p'):
             raise AttributeError("No property attribute 'p'")
         if k in self.__dict__['p']:
+            self._dirty()
             del self.__dict__['p'][k]
 
     def contains(self, key_or_keypath):
@@ -145,7 +155,7 @@ class DictCell(Cell):
         """
         if not isinstance(other, DictCell):
             return False
-        for (this, that) in itertools.izip_longest(self, other):
+        for (this, that) in itertools.izip_longest(self, other, fillvalue=(None, None)):
             if this[0] != that[0]:
                 # compare key names
                 return False
@@ -159,11 +169,17 @@ class DictCell(Cell):
         """ Iterate through first-level of sorted keys and values """
         return iter(sorted(self.__dict__['p'].items(), key=operator.itemgetter(0)))
 
+    def _adopt_parts(self):
+        # templates of DictCells (see columns.Column.template) have no parts
+        for part in (self.__dict__.get('p') or {}).itervalues():
+            self._adopt(part)
+
+    @cached_hash
     def __hash__(self):
         """ Iterate through all members and hash 'em """
         hash_val = 0
         for i, (key, val) in enumerate(self):
-            hash_val +=  hash(key) * hash(val) * DictCell.PRIMES[i]
+            hash_val +=  hash(key) * hash(val) * DictCell.PRIMES[i % len(DictCell.PRIMES)]
         if hash_val == -2:
             hash_val = -1
         return hash_val
@@ -181,12 +197,15 @@ class DictCell(Cell):
         elif other.is_entailed_by(self):
             return self
         elif self.is_entailed_by(other):
+            self._dirty()
             self.__dict__['p'] = other.__dict__['p'].copy()
+            self._adopt_parts()
         elif not self.is_contradictory(other):
             # partial information in both, add from other
+            self._dirty()
             for o_key, o_val in other:
                 if not o_key in self.__dict__['p']:
-                    self.__dict__['p'][o_key] = o_val
+                    self.__dict__['p'][o_key] = self._adopt(o_val)
                 else:
                     self.__dict__['p'][o_key].merge(o_val)
         else:
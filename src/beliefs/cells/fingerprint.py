@@ -0,0 +1,72 @@
+"""
+Deterministic content fingerprints of cells, for keying caches that are shared
+between processes or runs (where the salted `hash()` of strings differs).
+
+A fingerprint is the md5 digest (128 bits, as 32 hex digits) of a canonical
+encoding of a value: dictionaries are encoded with their items sorted, sets
+with their members sorted, numbers that are equal encode the same way, and a
+nested cell is encoded by its own (cached) fingerprint, so that a changed cell
+only needs the cells along its keypath to be fingerprinted again.
+
+Functions and classes are encoded by the name they are imported by, so
+lambdas, closures and nested functions (e.g. deferred effects made by a
+function that returns them), which no name identifies, cannot be fingerprinted;
+neither can objects that have no attributes to encode.  Both raise TypeError,
+rather than fingerprinting different values alike.
+"""
+import hashlib
+import sys
+import types
+import numpy as np
+
+
+def fingerprint(*values):
+    """ Returns the fingerprint of `values` """
+    return hashlib.md5(encode(values)).hexdigest()
+
+
+def encode(value):
+    """ Returns the canonical encoding of `value`, as a byte string """
+    if value is None:
+        return 'N'
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bool):
+        return 'T' if value else 'F'
+    if isinstance(value, (int, long)):
+        return 'i%d;' % value
+    if isinstance(value, float):
+        if value.is_integer():
+            return 'i%d;' % value
+        return 'f%r;' % value
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if isinstance(value, str):
+        return 's%d:%s' % (len(value), value)
+    if isinstance(value, (tuple, list)):
+        return '(%s)' % ''.join(encode(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ''.join(sorted(encode(item) for item in value))
+    if isinstance(value, dict):
+        return '<%s>' % ''.join(sorted(encode(key) + encode(val) \
+                for key, val in value.iteritems()))
+    if hasattr(value, 'fingerprint'):
+        # cells, and other objects that fingerprint themselves
+        return 'c%s' % value.fingerprint()
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type, types.ClassType)):
+        return 'g%s;' % global_name(value)
+    if isinstance(value, types.MethodType):
+        return 'm%s%s' % (encode(value.im_func), encode(value.im_self))
+    if hasattr(value, '__dict__'):
+        return 'o%s%s' % (global_name(value.__class__), encode(vars(value)))
+    raise TypeError("Cannot fingerprint %r, which has no canonical encoding" % (value,))
+
+
+def global_name(value):
+    """ Returns the 'module.name' that imports the function or class `value`,
+    or raises TypeError if there is none (as for lambdas and closures) """
+    module = getattr(value, '__module__', None)
+    name = getattr(value, '__name__', None)
+    if getattr(sys.modules.get(module), name, None) is not value:
+        raise TypeError("Cannot fingerprint %r, which is not imported by its name" % (value,))
+    return '%s.%s' % (module, name)
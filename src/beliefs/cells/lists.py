@@ -4,6 +4,9 @@ class LinearOrderedCell(Cell):
     """
     A generalization of IntervalCell to non-numeric symbols
     """
+    PACKED = ('domain', 'low', 'high')
+    SHARED = ('domain',)
+
     def __init__(self, ordered_domain, low=None, high=None):
         """
         Parameters:
@@ -128,6 +131,7 @@ class LinearOrderedCell(Cell):
             self.high =self.domain[min(map(to_i, [self.high, other.high]))]
         return self
 
+    @cached_hash
     def __hash__(self):
         return reduce(lambda x, y: hash(x) ^ hash(y), self.domain + [self.low, self.high], 0)
 
@@ -272,6 +276,7 @@ class ListCell(Cell):
         if self.value is None:
             self.value = [el]
         else:
+            self._dirty()
             self.value.append(el)
 
     def get_values(self):
@@ -283,6 +288,7 @@ class ListCell(Cell):
         else:
             return self.value[:]
 
+    @cached_hash
     def __hash__(self):
         return reduce(lambda x, y: hash(x) ^ hash(y), self.value, 0)
 
@@ -5,6 +5,7 @@ class IntervalCell(Cell):
     """
     Implements an interval cell along with interval algebra
     """
+    PACKED = ('low', 'high')
 
     def __init__(self, low=None, high=None):
         """
@@ -54,6 +55,12 @@ class IntervalCell(Cell):
         """ Creates a new instance """
         return self.__class__(0, np.inf)
 
+    def _pack(self, key, val):
+        """ Bounds are pickled as Python numbers, not NumPy scalars """
+        if isinstance(val, np.generic):
+            return val.item()
+        return val
+
     def size(self):
         """
         Number of possible values in the interval.  Boundaries are inclusive
@@ -222,6 +229,7 @@ class IntervalCell(Cell):
         """ Allows the use of Python's 'in' syntax """
         return self.low <= other <= self.high
 
+    @cached_hash
     def __hash__(self):
         """ Unique hash for interval """
         hval = 0
@@ -1,8 +1,89 @@
 #from .cell import *
 from beliefs.cells import *
+import bisect
 import networkx as nx
 import logging
-from networkx.algorithms.shortest_paths.generic import has_path
+from collections import OrderedDict
+from .taxonomy import CompiledTaxonomy, reachability_labels, validate
+
+
+class PosetValues(object):
+    """ The values of the posets with the same boundaries, which they share:
+    their bitset, their number, and (once asked for) the set of nodes """
+    __slots__ = ['bits', 'size', 'nodes']
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.size = bin(bits).count('1')
+        self.nodes = None
+
+    def get_nodes(self, order):
+        """ Returns the frozenset of nodes, where bit i stands for `order[i]` """
+        if self.nodes is None:
+            # the digits of the bitset, from bit 0
+            digits = bin(self.bits)[:1:-1]
+            self.nodes = frozenset(order[i] for i, digit in enumerate(digits) \
+                    if digit == '1')
+        return self.nodes
+
+
+class ValuesMemo(object):
+    """
+    The PosetValues of a domain, keyed by boundaries (frozensets of the upper
+    and of the lower nodes).  When it holds more than `capacity` of them, the
+    least recently used ones are evicted.
+    """
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self.entries = OrderedDict()  # boundaries -> PosetValues, LRU first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, boundaries):
+        """ Returns the PosetValues of `boundaries` (marking them as recently
+        used) or None.  Counts towards the hit rate. """
+        values = self.entries.pop(boundaries, None)
+        if values is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[boundaries] = values
+        return values
+
+    def store(self, boundaries, values):
+        """ Records the PosetValues of `boundaries` """
+        self.entries[boundaries] = values
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        """ Returns the fraction of lookups that found the values """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """ Returns the memo's instrumentation counters """
+        return {'entries': len(self.entries),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate(),
+                'evictions': self.evictions}
+
+    def clear(self):
+        """ Removes all entries, but keeps the counters """
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
 
 class PartialOrderedCell(Cell):
     """
@@ -23,17 +104,28 @@ class PartialOrderedCell(Cell):
 
     Generalization domain is a rooted directed graph with one component.  The
     (set of) root node(s) is the Upper generalization boundary, the set of Leaf
-    nodes is the lower generalization boundary. 
+    nodes is the lower generalization boundary.  Large domains can be compiled
+    ahead of time, and set as a CompiledTaxonomy (see cells.taxonomy).
 
     Contradictions mean that there is a directed path between one of the lower
     boundaries and the root.
     """
     domain_map = {}
+    roots_map = {}
+    reachability_map = {}  # class -> reachability_labels() of its domain
+    bitsets_map = {}  # class -> get_bitsets() of its domain
+    values_memo_map = {}  # class -> ValuesMemo of its domain
+    values_memo_capacity = 1024
+    DERIVED = ('values', 'roots', '_PartialOrderedCell__values_computed')
+
     def __init__(self, dag, lower=None, upper=None):
         """
         Dag represents the generalization structure.
         
-        The actual values are kept in two sets:  upper and lower
+        The actual values are kept in two sets:  upper and lower.  The values
+        between them are computed as a bitset over the nodes of the domain (see
+        `get_bitsets`), which is shared, as `values`, by the posets with the same
+        boundaries (see `get_values_memo`).
         """
         assert self.__class__ != PartialOrderedCell, "Don't instantiate this class--subclass it!"
         domain = self.get_domain()
@@ -41,17 +133,9 @@ class PartialOrderedCell(Cell):
             self.set_domain(dag)
             domain = dag
 
-        self.values = set()
+        self.values = None
         self.__values_computed = False
-        
-        roots = set()
-        
-        for node in domain.nodes():
-            # find the root nodes
-            if len(domain.predecessors(node)) == 0:
-                # add root nodes to upper generalization bound
-                roots.add(node)
-        self.roots = frozenset(roots)
+        self.roots = self.get_roots()
         
         if not (lower is None or upper is None):
             # TODO(dustin): check that all members of lower/upper
@@ -65,23 +149,121 @@ class PartialOrderedCell(Cell):
 
     @classmethod
     def set_domain(clz, dag):
-        """ Sets the domain.  Should only be called once per class instantiation. """
+        """ Sets the domain, an nx.DiGraph or a CompiledTaxonomy (which was
+        validated when it was compiled).  Should only be called once per class
+        instantiation. """
         logging.info("Setting domain for poset %s" % clz.__name__)
-        if nx.number_of_nodes(dag) == 0:
-            raise CellConstructionFailure("Empty DAG structure.")
-            
-        if not nx.is_directed_acyclic_graph(dag):
-            raise CellConstructionFailure("Must be directed and acyclic")
-
-        if not nx.is_weakly_connected(dag):
-            raise CellConstructionFailure("Must be connected")
+        if not isinstance(dag, CompiledTaxonomy):
+            validate(dag)
         clz.domain_map[clz] = dag
+        clz.roots_map.pop(clz, None)
+        clz.reachability_map.pop(clz, None)
+        clz.bitsets_map.pop(clz, None)
+        clz.values_memo_map.pop(clz, None)
         
     @classmethod
     def get_domain(clz):
         """ Returns the class domain. """
         return clz.domain_map.get(clz, None)
         
+    @classmethod
+    def get_roots(clz):
+        """ Returns the root nodes of the class domain, which are computed once """
+        roots = clz.roots_map.get(clz)
+        if roots is None:
+            domain = clz.get_domain()
+            if isinstance(domain, CompiledTaxonomy):
+                roots = domain.roots()
+            else:
+                # nodes without predecessors
+                roots = frozenset(node for node in domain.nodes() \
+                        if len(domain.predecessors(node)) == 0)
+            clz.roots_map[clz] = roots
+        return roots
+
+    @classmethod
+    def reaches(clz, general, specific):
+        """
+        Returns True iff there is a path from `general` to `specific` in the
+        class domain (like networkx's has_path), using the reachability labels
+        of the domain, which are computed once.
+        """
+        reachability = clz.reachability_map.get(clz)
+        if reachability is None:
+            domain = clz.get_domain()
+            if isinstance(domain, CompiledTaxonomy):
+                # its labels are compiled
+                return domain.reaches(general, specific)
+            reachability = reachability_labels(domain)
+            clz.reachability_map[clz] = reachability
+        post, labels = reachability
+        number = post.get(specific)
+        if number is None or general not in labels:
+            return False
+        starts, ends = labels[general]
+        i = bisect.bisect_right(starts, number) - 1
+        return i >= 0 and number <= ends[i]
+
+    @classmethod
+    def get_bitsets(clz):
+        """
+        Returns (nodes, positions, descendants) for the class domain, which are
+        computed once: bit i of a bitset (a long) stands for `nodes[i]`,
+        `positions` maps the nodes to their bits, and `descendants` maps every
+        node to the bitset of itself and its descendants.
+        """
+        bitsets = clz.bitsets_map.get(clz)
+        if bitsets is None:
+            domain = clz.get_domain()
+            if isinstance(domain, CompiledTaxonomy):
+                # the descendants are computed from the compiled labels, as
+                # they are needed
+                bitsets = domain.bitsets()
+            else:
+                order = nx.topological_sort(domain)
+                positions = dict((node, i) for i, node in enumerate(order))
+                descendants = {}
+                for node in reversed(order):
+                    bits = 1 << positions[node]
+                    for child in domain.successors(node):
+                        bits |= descendants[child]
+                    descendants[node] = bits
+                bitsets = (order, positions, descendants)
+            clz.bitsets_map[clz] = bitsets
+        return bitsets
+
+    @classmethod
+    def get_values_memo(clz):
+        """ Returns the ValuesMemo of the class domain, whose `stats()` tell how
+        often posets share their values """
+        memo = clz.values_memo_map.get(clz)
+        if memo is None:
+            memo = clz.values_memo_map[clz] = ValuesMemo(clz.values_memo_capacity)
+        return memo
+
+    @classmethod
+    def descendant_bits(clz, nodes):
+        """ Returns the bitset of `nodes` and their descendants """
+        descendants = clz.get_bitsets()[2]
+        bits = 0
+        for node in nodes:
+            bits |= descendants[node]
+        return bits
+
+    def values_between(self, upper, lower):
+        """ Returns the bitset of the values of a poset with the boundaries
+        `upper` and `lower`: the descendants of the upper boundary that are not
+        descendants of the lower one """
+        nub = self.compute_upper_bound(upper) - lower
+        return self.descendant_bits(nub) & ~self.descendant_bits(lower)
+
+    def __setstate__(self, state):
+        """ Restores a pickled state; the values and roots are recomputed """
+        Cell.__setstate__(self, state)
+        self.__dict__['roots'] = self.get_roots()
+        self.__dict__['values'] = None
+        self.__dict__['_PartialOrderedCell__values_computed'] = False
+
     @classmethod
     def has_domain(clz):
         """ Returns True iff the class' domain is specified """
@@ -91,9 +273,16 @@ class PartialOrderedCell(Cell):
         """
         Returns positive members of the poset
         """
+        return set(self.get_shared_values())
+
+    def get_shared_values(self):
+        """
+        Returns positive members of the poset, as a frozenset that is shared
+        with the posets that have the same boundaries
+        """
         if not self.__values_computed:
             self.__compute_values()
-        return  set(self.values)
+        return self.values.get_nodes(self.get_bitsets()[0])
 
     def get_boundaries(self):
         """
@@ -105,42 +294,37 @@ class PartialOrderedCell(Cell):
             self.__compute_values()
         return set(self.upper), set(self.lower)
    
-    def compute_upper_bound(self):
+    def compute_upper_bound(self, upper=None):
         """
         We have to compute the new upper boundary (nub) starting from the
         root nodes.  If a path exists between a root node and another entry in
-        `self.upper` we can ignore the root node because it has been
-        specialized by one of its successors.
+        `self.upper` (or `upper`) we can ignore the root node because it has
+        been specialized by one of its successors.
         """
+        if upper is None:
+            upper = self.upper
         nub = set()
-        for root in self.roots - self.upper:
+        for root in self.roots - upper:
             found = False
-            for up in self.upper - self.roots:
-                domain = self.get_domain()
-                if has_path(domain, root, up):
+            for up in upper - self.roots:
+                if self.reaches(root, up):
                     found = True
                     break
             if not found:
                 nub.add(root)
-        return nub | (self.upper - self.roots)
+        return nub | (upper - self.roots)
         
     def __compute_values(self):
-        seen = set()
-        nub = self.compute_upper_bound() - self.lower
-        agenda = list(nub)
-        while len(agenda) != 0:
-            to_visit = agenda.pop(0)
-            domain = self.get_domain()
-            for child in domain.successors(to_visit):
-                if not (child in seen \
-                     or child in self.lower \
-                     or child in agenda):
-                     seen.add(child)
-                     agenda.append(child)
-        # if a node is in both sets, it meens our boundary is collapsed
-        conflated = self.lower.intersection(self.upper)
-        self.values = seen.union(nub) - conflated
-        self.__values_computed = True
+        boundaries = (frozenset(self.upper), frozenset(self.lower))
+        memo = self.get_values_memo()
+        values = memo.lookup(boundaries)
+        if values is None:
+            values = PosetValues(self.values_between(self.upper, self.lower))
+            memo.store(boundaries, values)
+        # the values are derived from the boundaries, so computing them does
+        # not change the cell
+        self.__dict__['values'] = values
+        self.__dict__['_PartialOrderedCell__values_computed'] = True
 
     def is_domain_equal(self, other):
         """
@@ -170,11 +354,12 @@ class PartialOrderedCell(Cell):
             return True
         return False
 
+    @cached_hash
     def __hash__(self):
         """ Returns the hash value """
         if not self.__values_computed:
             self.__compute_values()
-        return Cell.__hash__(self)
+        return hash(self.values.bits)
 
     def is_entailed_by(self, other):
         """
@@ -208,7 +393,6 @@ class PartialOrderedCell(Cell):
            to other[j]), we return False, indicating Other does not entail
            Self.
         """
-        domain = self.get_domain()
         self_full_upper = self.compute_upper_bound()
         if not (len(self.upper) == 0 \
              or other.upper.issuperset(self.upper)):
@@ -217,7 +401,7 @@ class PartialOrderedCell(Cell):
                 # find a more specific member for each member
                 # of self.upper that's not in other.upper
                 for other_up in other.upper - self_full_upper:
-                    if has_path(domain, self_up, other_up):
+                    if self.reaches(self_up, other_up):
                         found = True
                         break
                 if found:
@@ -237,7 +421,7 @@ class PartialOrderedCell(Cell):
             for self_lo in self.lower - other.lower:
                 found = False
                 for other_lo in other.lower - self.lower:
-                    if has_path(domain, self_lo, other_lo):
+                    if self.reaches(self_lo, other_lo):
                         found =True
                         break
                 if found:
@@ -259,16 +443,14 @@ class PartialOrderedCell(Cell):
         test_lower = self.lower.union(other.lower)
         test_upper = self.upper.union(other.upper)
         # if there is a path from lower to upper nodes, we're in trouble:
-        domain = self.get_domain()
+        _, positions, descendants = self.get_bitsets()
+        below_lower = 0
         for low in test_lower:
-            for high in test_upper:
-                if low != high and has_path(domain, low, high):
-                    return True
-        # lastly, build a merged ordering and see if it has 0 members
-        test = self.__class__()
-        test.lower = test_lower
-        test.upper = test_upper
-        return len(test) == 0
+            below_lower |= descendants[low] & ~(1 << positions[low])
+        if any(below_lower >> positions[high] & 1 for high in test_upper):
+            return True
+        # lastly, see if the merged ordering has 0 members
+        return self.values_between(test_upper, test_lower) == 0
 
     def coerce(self, other, is_positive=True):
         """
@@ -327,6 +509,7 @@ class PartialOrderedCell(Cell):
             raise Contradiction("Cannot merge partial orders")
         else:
             # merge the two
+            self._dirty()
             def add_single_value(val, is_positive):
                 if not is_positive:
                     # lower generalization boundaries
@@ -356,7 +539,9 @@ class PartialOrderedCell(Cell):
         Return the number of members in the partial ordering (between and
         including the boundaries)
         """
-        return len(self.get_values())
+        if not self.__values_computed:
+            self.__compute_values()
+        return self.values.size
 
     def to_dot(self):
         """
@@ -373,7 +558,7 @@ class PartialOrderedCell(Cell):
         output += "\t\tUPPER = " + ','.join(self.upper) + "\n"
         output += "\t\tLOWER = " + ','.join(self.lower) + "\n"
         output += "\t\tVALUES = "
-        values = self.get_values()
+        values = self.get_shared_values()
         output += ",".join(list(values)[0:6])
         if len(values) > 6:
             output += "... (and %i others)" % (len(values)-5)
@@ -406,10 +591,141 @@ class PartialOrderedCell(Cell):
     def to_dotfile(self):
         """ Writes a DOT graphviz file of the domain structure, and returns the filename"""
         domain = self.get_domain()
+        if isinstance(domain, CompiledTaxonomy):
+            domain = domain.to_digraph()
         filename = "%s.dot" % (self.__class__.__name__)
         nx.write_dot(domain, filename)
         return filename
 
+def test_reachability_labels():
+    import random
+    from networkx.algorithms.shortest_paths.generic import has_path
+    rng = random.Random(3)
+    dag = nx.DiGraph()
+    dag.add_node(0)
+    for node in xrange(1, 60):
+        # every node has one to three parents among the earlier nodes
+        for parent in rng.sample(xrange(node), min(node, rng.randint(1, 3))):
+            dag.add_edge(parent, node)
+    post, labels = reachability_labels(dag)
+    for general in dag.nodes():
+        starts, ends = labels[general]
+        for specific in dag.nodes():
+            number = post[specific]
+            i = bisect.bisect_right(starts, number) - 1
+            assert (i >= 0 and number <= ends[i]) == has_path(dag, general, specific)
+
+    class Reachable(PartialOrderedCell):
+        def __init__(self):
+            PartialOrderedCell.__init__(self, None if self.has_domain() else dag)
+    cell = Reachable()
+    assert cell.roots == frozenset([0])
+    assert Reachable.reaches(0, 59) and Reachable.reaches(7, 7)
+    assert not Reachable.reaches(59, 0) and not Reachable.reaches(0, 'missing')
+
+
+
+def test_bitset_values():
+    import random
+    rng = random.Random(5)
+    tree = nx.DiGraph()
+    tree.add_node(0)
+    for node in xrange(1, 40):
+        tree.add_edge(rng.randrange(node), node)
+
+    class Bitset(PartialOrderedCell):
+        def __init__(self):
+            PartialOrderedCell.__init__(self, None if self.has_domain() else tree)
+    for _ in xrange(200):
+        cell = Bitset()
+        cell.upper = set(rng.sample(xrange(40), rng.randint(0, 2)))
+        cell.lower = set(rng.sample(xrange(40), rng.randint(0, 2)))
+        expected = set()
+        for node in cell.compute_upper_bound() - cell.lower:
+            expected |= nx.descendants(tree, node) | set([node])
+        for node in cell.lower:
+            expected -= nx.descendants(tree, node) | set([node])
+        assert cell.get_values() == expected and len(cell) == len(expected)
+        other = Bitset()
+        other.upper = set([rng.randrange(40)])
+        merged = Bitset()
+        merged.upper, merged.lower = cell.upper | other.upper, set(cell.lower)
+        assert cell.is_contradictory(other) == (len(merged) == 0 or any(
+            low != high and nx.has_path(tree, low, high) for low in cell.lower for high in merged.upper))
+
+
+def test_values_memo():
+    tree = nx.DiGraph()
+    for node in xrange(1, 15):
+        tree.add_edge((node - 1) // 2, node)
+
+    class Memoized(PartialOrderedCell):
+        values_memo_capacity = 2
+        def __init__(self, upper=()):
+            PartialOrderedCell.__init__(self, None if self.has_domain() else tree)
+            self.upper = set(upper)
+    first, second = Memoized([1]), Memoized([1])
+    assert first.get_shared_values() is second.get_shared_values()
+    # callers may change the values they get
+    values = first.get_values()
+    values.add(2)
+    assert isinstance(values, set) and 2 not in second.get_values()
+    assert first.get_values() == frozenset([1, 3, 4, 7, 8, 9, 10]) and len(second) == 7
+    memo = Memoized.get_values_memo()
+    assert (memo.hits, memo.misses) == (1, 1) and memo.hit_rate() == 0.5
+    third = Memoized([1])
+    third.lower = set([3])
+    assert third.get_values() == frozenset([1, 4, 9, 10])
+    # the least recently used boundaries are evicted
+    assert len(Memoized([2])) == 7 and len(memo) == 2 and memo.evictions == 1
+    assert len(Memoized([1])) == 7 and memo.misses == 4
+    assert memo.stats()['entries'] == 2 and memo.stats()['evictions'] == 2
+
+
+def test_compiled_taxonomy():
+    import random
+    import shutil
+    import tempfile
+    rng = random.Random(7)
+    dag = nx.DiGraph()
+    for node in xrange(1, 50):
+        for parent in rng.sample(xrange(node), min(node, rng.randint(1, 2))):
+            dag.add_edge('n%i' % parent, 'n%i' % node)
+    path = tempfile.mkdtemp()
+    try:
+        CompiledTaxonomy.compile(dag, path)
+
+        class Graph(PartialOrderedCell):
+            def __init__(self):
+                PartialOrderedCell.__init__(self, None if self.has_domain() else dag)
+
+        class Compiled(PartialOrderedCell):
+            def __init__(self):
+                PartialOrderedCell.__init__(self, None if self.has_domain() else \
+                        CompiledTaxonomy(path))
+        taxonomy = Compiled().get_domain()
+        assert Compiled().roots == Graph().roots == frozenset(['n0'])
+        for node in dag.nodes():
+            assert set(taxonomy.successors(node)) == set(dag.successors(node))
+            assert set(taxonomy.predecessors(node)) == set(dag.predecessors(node))
+            assert taxonomy.ancestors(node) == nx.ancestors(dag, node)
+            for other in dag.nodes():
+                assert Compiled.reaches(node, other) == Graph.reaches(node, other)
+        assert nx.is_isomorphic(taxonomy.to_digraph(), dag)
+        for _ in xrange(100):
+            upper = set(rng.sample(dag.nodes(), rng.randint(0, 2)))
+            lower = set(rng.sample(dag.nodes(), rng.randint(0, 2)))
+            compiled, graph = Compiled(), Graph()
+            compiled.upper, compiled.lower = set(upper), set(lower)
+            graph.upper, graph.lower = set(upper), set(lower)
+            assert compiled.get_values() == graph.get_values()
+            node = rng.choice(dag.nodes())
+            assert compiled.is_contradictory(Compiled().merge(node)) == \
+                    graph.is_contradictory(Graph().merge(node))
+    finally:
+        shutil.rmtree(path)
+
+
 if __name__ == '__main__':
 
     class TestPOC(PartialOrderedCell):
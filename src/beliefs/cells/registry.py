@@ -0,0 +1,126 @@
+"""
+A registry of the objects that many pickled cells and beliefstates share: the
+domains of cells (of SetIntersectionCells and LinearOrderedCells) and
+referential domains.
+
+Pickles are self-contained: a shared object is pickled along with its key (see
+`pack`), once per pickle, and unpickling it returns the object registered with
+that key in this process, if there is one, so that unpickled cells share it
+rather than copies of it.  Only the objects registered with `register()`, which
+the processes that unpickle them are expected to register as well, are
+pickled as their key alone.
+
+Domains are keyed by their content, so a process that registers a domain with
+the same members (for instance, by building the columns of the same
+referential domain) has the same key.  Referential domains are keyed by
+their `registry_key` attribute, if they have one, and otherwise by their
+identity in this process, which processes forked after the registration share.
+"""
+import hashlib
+import random
+
+_objects = {}  # key -> shared object
+_domain_keys = {}  # (kind, frozenset or tuple of members) -> key
+_object_keys = {}  # id(object) -> key
+_registered = set()  # keys of the objects registered with register()
+# tells the identities of objects in this process (and its forks) from those in others
+_process = "%08x" % random.getrandbits(32)
+
+
+def key(obj):
+    """ Registers a domain (a set, list or tuple) or another object, such as a
+    referential domain, and returns its key """
+    if isinstance(obj, (set, frozenset, list, tuple)):
+        return domain_key(obj)
+    return object_key(obj)
+
+
+def domain_key(domain):
+    """ Registers a set or list (or tuple) domain and returns its key """
+    if isinstance(domain, (list, tuple)):
+        content = ('list', tuple(domain))
+    else:
+        content = ('set', frozenset(domain))
+    key = _domain_keys.get(content)
+    if key is None:
+        members = content[1] if content[0] == 'list' else sorted(content[1], key=repr)
+        key = "%s:%s" % (content[0], hashlib.md5(repr(list(members))).hexdigest()[:16])
+        _domain_keys[content] = key
+        _objects[key] = list(domain) if content[0] == 'list' else set(domain)
+    return key
+
+
+def object_key(obj):
+    """ Registers an object, such as a referential domain, and returns its key """
+    key = _object_keys.get(id(obj))
+    if key is None or _objects.get(key) is not obj:
+        key = getattr(obj, 'registry_key', None) or \
+                "%s@%x.%s" % (obj.__class__.__name__, id(obj), _process)
+        _object_keys[id(obj)] = key
+        _objects[key] = obj
+    return key
+
+
+def register(obj, key):
+    """ Registers `obj` under an explicit `key`, so that it is pickled as the
+    key alone, and unpickled as `obj` by the processes that register it too """
+    _objects[key] = obj
+    _object_keys[id(obj)] = key
+    _registered.add(key)
+    return key
+
+
+def unregister(key):
+    """ Undoes `register()`: the object is pickled with its key again """
+    obj = _objects.pop(key, None)
+    _registered.discard(key)
+    if obj is not None and _object_keys.get(id(obj)) == key:
+        del _object_keys[id(obj)]
+
+
+def registered_key(obj):
+    """ Returns the key that `obj` was registered with by `register()`, or None """
+    key = _object_keys.get(id(obj))
+    if key in _registered and _objects.get(key) is obj:
+        return key
+    return None
+
+
+class Packed(tuple):
+    """ The (key, object) pair that an unregistered object is pickled as """
+
+
+def pack(obj, key):
+    """ Returns what is pickled for `obj`, which is registered as `key`: the key
+    alone if it was registered with `register()`, and otherwise a Packed pair
+    of the key and the object """
+    if key in _registered:
+        return key
+    return Packed((key, obj))
+
+
+def unpack(packed):
+    """ Returns the object that `pack()` returned `packed` for: the object
+    registered with its key in this process, or else the unpickled object,
+    which is registered with it.  Objects that were pickled before they had
+    keys are returned as they are. """
+    if isinstance(packed, basestring):
+        return resolve(packed)
+    if isinstance(packed, Packed):
+        key, obj = packed
+        return _objects.setdefault(key, obj)
+    return packed
+
+
+def lookup(key):
+    """ Returns the object registered as `key`, or None """
+    return _objects.get(key)
+
+
+def resolve(key):
+    """ Returns the object registered as `key` """
+    try:
+        return _objects[key]
+    except KeyError:
+        raise KeyError("%r is not registered in this process; register the " \
+                "object before unpickling" % (key,))
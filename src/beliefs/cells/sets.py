@@ -8,6 +8,9 @@ class SetIntersectionCell(Cell):
     """
     Represents iterable unordered elements.
     """
+    PACKED = ('domain', 'values')
+    SHARED = ('domain',)
+
     def __init__(self, domain, value_or_values=None):
         """
         Initializes a SetCell with a domain of `domain` and optionally, a
@@ -152,6 +155,7 @@ class SetIntersectionCell(Cell):
         """ For Graphviz rendering """
         return ",".join(self.get_values())
 
+    @cached_hash
     def __hash__(self):
         """
         A set's hash is the aggregate XOR of its children's hashes
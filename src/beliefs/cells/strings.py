@@ -5,6 +5,8 @@ class StringCell(Cell):
     """
     Strings can be merged when one is a subsequence of another
     """
+    PACKED = ('value',)
+
     def __init__(self, value=None):
         """
         Creates a new StringCell, optionally with an initial value.
@@ -0,0 +1,264 @@
+"""
+A compiled form of the taxonomies (directed acyclic graphs) of
+PartialOrderedCells, for is-a hierarchies too large to rebuild as an
+nx.DiGraph, and validate, in every process.
+
+`CompiledTaxonomy.compile` validates a DiGraph once and stores it in a
+directory of NumPy arrays, which `CompiledTaxonomy` memory-maps (so processes
+that open the same directory share them through the page cache):
+
+    >> CompiledTaxonomy.compile(dag, '/tmp/wordnet')
+    >> WordNetCell.set_domain(CompiledTaxonomy('/tmp/wordnet'))
+
+The nodes are numbered in the postorder of a spanning tree of the graph (see
+`reachability_labels`), so the number of a node is both the position of its
+bit in the bitsets of PartialOrderedCell and the number of its reachability
+label; the arrays are
+
+    - the successors and the predecessors of every node, in CSR form (the
+      neighbours of node i are `targets[offsets[i]:offsets[i+1]]`)
+    - the reachability intervals of every node, in the same form
+    - the numbers of the roots
+
+and the names of the nodes, in number order, are stored in 'taxonomy.json'.
+"""
+import bisect
+import json
+import os
+import networkx as nx
+import numpy as np
+from .exceptions import CellConstructionFailure
+
+
+def validate(dag):
+    """ Raises CellConstructionFailure unless `dag` is a non-empty, connected,
+    directed acyclic graph """
+    if nx.number_of_nodes(dag) == 0:
+        raise CellConstructionFailure("Empty DAG structure.")
+
+    if not nx.is_directed_acyclic_graph(dag):
+        raise CellConstructionFailure("Must be directed and acyclic")
+
+    if not nx.is_weakly_connected(dag):
+        raise CellConstructionFailure("Must be connected")
+
+
+def reachability_labels(dag):
+    """
+    Labels the nodes of a DAG so that reachability is answered without
+    searching the graph (Agrawal, Borgida and Jagadish's interval labels):
+
+      - `post` numbers the nodes in postorder of a spanning tree of the DAG,
+        so the descendants of a node in the tree are an interval of numbers
+        that ends with its own;
+      - `labels` maps every node to the intervals of all of its descendants in
+        the DAG, which are its tree interval and its successors' intervals,
+        merged, as (starts, ends) sorted lists.
+
+    A node reaches another iff the other's number is in one of its intervals;
+    on a tree (such as a class hierarchy) every node has a single interval.
+    """
+    order = nx.topological_sort(dag)
+    children = dict((node, []) for node in order)
+    roots = []
+    for node in order:
+        parents = dag.predecessors(node)
+        if parents:
+            # the first parent in topological order is the tree parent
+            children[parents[0]].append(node)
+        else:
+            roots.append(node)
+    post, low = {}, {}
+    for root in roots:
+        stack = [(root, iter(children[root]))]
+        low[root] = len(post)
+        while stack:
+            node, remaining = stack[-1]
+            child = next(remaining, None)
+            if child is None:
+                stack.pop()
+                post[node] = len(post)
+            else:
+                low[child] = len(post)
+                stack.append((child, iter(children[child])))
+    labels = {}
+    for node in reversed(order):
+        intervals = [(low[node], post[node])]
+        for child in dag.successors(node):
+            intervals.extend(zip(*labels[child]))
+        intervals.sort()
+        starts, ends = [], []
+        for start, end in intervals:
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        labels[node] = (starts, ends)
+    return post, labels
+
+
+class DescendantBits(dict):
+    """ Maps the nodes of a CompiledTaxonomy to the bitsets of themselves and
+    their descendants, which are computed from their reachability intervals
+    when they are first asked for """
+
+    def __init__(self, taxonomy):
+        dict.__init__(self)
+        self.taxonomy = taxonomy
+
+    def __missing__(self, node):
+        bits = 0
+        for start, end in self.taxonomy.intervals(node):
+            bits |= (1 << (end + 1)) - (1 << start)
+        self[node] = bits
+        return bits
+
+
+class CompiledTaxonomy(object):
+    """
+    A taxonomy stored by `compile()`.  It answers the queries that
+    PartialOrderedCell (and PosetColumn) make of an nx.DiGraph domain from its
+    memory-mapped arrays, and reachability from its labels.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'taxonomy.json')) as source:
+            info = json.load(source)
+        self.names = [self.intern(name) for name in info['nodes']]
+        self.ids = dict((name, i) for i, name in enumerate(self.names))
+        self.successor_csr, self.predecessor_csr, self.label_csr = \
+                [(self.array(name + '.offsets'), self.array(name + '.targets')) \
+                for name in ('successors', 'predecessors', 'labels')]
+        self.ends = self.array('labels.ends')
+        self.root_ids = self.array('roots')
+
+    @staticmethod
+    def intern(name):
+        """ JSON strings are unicode; ASCII ones are interned as str """
+        if not isinstance(name, unicode):
+            return name
+        try:
+            return intern(name.encode('ascii'))
+        except UnicodeEncodeError:
+            return name
+
+    def array(self, name):
+        filename = os.path.join(self.path, "%s.npy" % name)
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            # empty arrays cannot be mapped
+            return np.load(filename)
+
+    @classmethod
+    def compile(clz, dag, path):
+        """ Validates the nx.DiGraph `dag` and stores it in the directory
+        `path`, whose nodes must be strings or numbers.  Returns the compiled
+        taxonomy. """
+        validate(dag)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        post, labels = reachability_labels(dag)
+        names = sorted(post, key=post.get)
+
+        def save(name, lists):
+            offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(targets) for targets in lists])
+            np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+            np.save(os.path.join(path, name + '.targets.npy'),
+                    np.array([i for targets in lists for i in targets], dtype=np.int32))
+
+        save('successors', [sorted(post[n] for n in dag.successors(node)) for node in names])
+        save('predecessors', [sorted(post[n] for n in dag.predecessors(node)) for node in names])
+        # the labels' starts are stored as their targets
+        save('labels', [labels[node][0] for node in names])
+        np.save(os.path.join(path, 'labels.ends.npy'),
+                np.array([end for node in names for end in labels[node][1]], dtype=np.int32))
+        np.save(os.path.join(path, 'roots.npy'), np.array([post[node] for node in names \
+                if not dag.predecessors(node)], dtype=np.int32))
+        with open(os.path.join(path, 'taxonomy.json'), 'w') as out:
+            json.dump({'nodes': names}, out)
+        return clz(path)
+
+    def neighbours(self, csr, node):
+        offsets, targets = csr
+        i = self.ids[node]
+        return [self.names[j] for j in targets[offsets[i]:offsets[i + 1]]]
+
+    def successors(self, node):
+        """ Returns the list of the children of `node` """
+        return self.neighbours(self.successor_csr, node)
+
+    def predecessors(self, node):
+        """ Returns the list of the parents of `node` """
+        return self.neighbours(self.predecessor_csr, node)
+
+    def ancestors(self, node):
+        """ Returns the set of the nodes that reach `node`, other than itself """
+        offsets, targets = self.predecessor_csr
+        found = set()
+        stack = [self.ids[node]]
+        while stack:
+            i = stack.pop()
+            for j in targets[offsets[i]:offsets[i + 1]]:
+                if j not in found:
+                    found.add(j)
+                    stack.append(j)
+        return set(self.names[i] for i in found)
+
+    def roots(self):
+        """ Returns the frozenset of the nodes without predecessors """
+        return frozenset(self.names[i] for i in self.root_ids)
+
+    def intervals(self, node):
+        """ Returns the (start, end) intervals of the numbers of the nodes that
+        `node` reaches, itself included """
+        offsets, starts = self.label_csr
+        i = self.ids[node]
+        begin, end = offsets[i], offsets[i + 1]
+        return zip(starts[begin:end].tolist(), self.ends[begin:end].tolist())
+
+    def reaches(self, general, specific):
+        """ Returns True iff there is a path from `general` to `specific` """
+        i = self.ids.get(general)
+        number = self.ids.get(specific)
+        if i is None or number is None:
+            return False
+        offsets, starts = self.label_csr
+        begin, end = int(offsets[i]), int(offsets[i + 1])
+        if end - begin == 1:
+            # a single interval, as in a tree
+            return bool(starts[begin] <= number <= self.ends[begin])
+        k = bisect.bisect_right(starts[begin:end].tolist(), number) - 1
+        return k >= 0 and bool(number <= self.ends[begin + k])
+
+    def bitsets(self):
+        """ Returns (nodes, positions, descendants), as computed by
+        PartialOrderedCell.get_bitsets, where bit i stands for node number i """
+        return (self.names, self.ids, DescendantBits(self))
+
+    def to_digraph(self):
+        """ Returns the taxonomy as an nx.DiGraph """
+        dag = nx.DiGraph()
+        dag.add_nodes_from(self.names)
+        offsets, targets = self.successor_csr
+        for i, name in enumerate(self.names):
+            dag.add_edges_from((name, self.names[j]) for j in targets[offsets[i]:offsets[i + 1]])
+        return dag
+
+    def nodes(self):
+        return list(self.names)
+
+    def number_of_nodes(self):
+        return len(self.names)
+
+    def __contains__(self, node):
+        return node in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
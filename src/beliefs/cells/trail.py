@@ -0,0 +1,91 @@
+"""
+An undo trail for speculative changes to cells, in the style of the trail of
+the Warren Abstract Machine.
+
+While a Trail is active (`Cell.trail`), every cell records a snapshot of its
+state the first time it changes after the latest checkpoint, so that rolling
+back to a checkpoint restores the changed cells, in reverse order, in
+O(changes) rather than copying the whole structure beforehand:
+
+    >> mark = belief.checkpoint()
+    >> try:
+    >>     belief.merge(['target', 'color'], 'red')
+    >> except Contradiction:
+    >>     ...
+    >> belief.rollback(mark)
+"""
+from .cell import Cell
+
+
+class Trail(object):
+    """ The snapshots of the cells changed since the open checkpoints """
+
+    def __init__(self):
+        self.entries = []   # (cell, snapshot) in the order of the changes
+        self.marks = []     # length of entries at each open checkpoint
+        self.recorded = {}  # ids of the cells recorded since the last mark
+
+    def checkpoint(self):
+        """ Opens a checkpoint and returns its mark """
+        self.marks.append(len(self.entries))
+        self.recorded.clear()
+        return len(self.marks) - 1
+
+    def record(self, cell):
+        """ Records the state of `cell`, which is about to change, unless it was
+        recorded since the last checkpoint """
+        if self.marks and id(cell) not in self.recorded:
+            self.recorded[id(cell)] = cell
+            self.entries.append((cell, cell._snapshot()))
+
+    def rollback(self, mark):
+        """ Undoes the changes made since the checkpoint `mark` was opened, and
+        closes it (along with the checkpoints opened after it) """
+        self._check(mark)
+        length = self.marks[mark]
+        while len(self.entries) > length:
+            cell, snapshot = self.entries.pop()
+            cell._restore(snapshot)
+        del self.marks[mark:]
+        self.recorded.clear()
+
+    def commit(self, mark):
+        """ Keeps the changes made since the checkpoint `mark` was opened, and
+        closes it (along with the checkpoints opened after it).  They can still
+        be undone by rolling back to an earlier checkpoint. """
+        self._check(mark)
+        del self.marks[mark:]
+        if not self.marks:
+            del self.entries[:]
+        self.recorded.clear()
+
+    def _check(self, mark):
+        if not 0 <= mark < len(self.marks):
+            raise ValueError("No open checkpoint %r" % (mark,))
+
+    def is_open(self):
+        """ Whether a checkpoint is open """
+        return bool(self.marks)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def trailed(method):
+    """
+    Decorates a method of an object with a `trail` (in its __dict__) so that
+    the cells it changes are recorded in that trail, if a checkpoint is open.
+    """
+    def wrapper(self, *args, **kwargs):
+        trail = self.__dict__.get('trail')
+        if trail is None or not trail.marks or Cell.trail is trail:
+            return method(self, *args, **kwargs)
+        previous = Cell.trail
+        Cell.trail = trail
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            Cell.trail = previous
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
@@ -0,0 +1,1024 @@
+"""
+A columnar mirror of a referential domain.
+
+BeliefState tests every entity of its referential domain against the 'target'
+and 'distractor' DictCells.  Doing that one entity at a time walks each
+entity's DictCell tree in Python.  ColumnarDomain instead stores every keypath
+of the entities as a column of NumPy arrays:
+
+    - IntervalCells as `low` and `high` float arrays
+    - BoolCells, StringCells, LinearOrderedCells and PartialOrderedCells as
+      dictionary-encoded value codes
+    - SetIntersectionCells as a dictionary-encoded membership matrix
+
+so that a whole target (or distractor) constraint can be tested against all of
+the entities at once, yielding a boolean mask over the entities:
+
+    >> columns = ColumnarDomain(referential_domain)
+    >> mask = columns.mask(belief['target'])
+
+The categorical and set columns also keep an inverted index: for every
+distinct value, the bitmap of the entities that have it, packed 8 entities to
+a byte.  Testing a part of 'target' against them is then a union of the
+bitmaps of the values that entail it (or, for sets, the difference with the
+bitmaps of the values outside of it; for taxonomies, the bitmap of a node's
+descendants), and BeliefState intersects the part
+bitmaps of 'target' and subtracts those of 'distractor' before unpacking them:
+
+    >> bitmap = columns.part_bitmap(('color',), belief['target']['color'])
+
+Cells that cannot be vectorized fall back to calling `entails()` on each
+entity, which is exactly what `DictCell.is_entailed_by` does.
+
+A ColumnarDomain can be exported to a directory of NumPy arrays, plus an
+interned table of its strings, so that other processes can open it as a
+MappedDomain, whose arrays are memory-mapped (and shared between processes
+through the page cache) and whose entities are only rebuilt when they are
+accessed:
+
+    >> ColumnarDomain.for_domain(referential_domain).export('/tmp/domain')
+    >> belief = BeliefState(MappedDomain('/tmp/domain'))
+"""
+import copy
+import cPickle as pickle
+import itertools
+import json
+import os
+import weakref
+import networkx as nx
+import numpy as np
+from beliefs.cells import *
+from beliefs.cells import registry
+from beliefs.cells import fingerprint as fingerprints
+
+
+def _uses(cell_or_class, name, owner):
+    """ Returns True iff `cell_or_class` uses `owner`'s implementation of the
+    method called `name`, so its semantics are those of `owner`. """
+    if not isinstance(cell_or_class, type):
+        cell_or_class = type(cell_or_class)
+    method = getattr(cell_or_class, name, None)
+    return getattr(method, '__func__', None) is getattr(owner, name).__func__
+
+
+def pack(mask):
+    """ Packs a boolean mask over the entities into a bitmap """
+    return np.packbits(mask)
+
+
+def unpack(bitmap, n):
+    """ Unpacks a bitmap (with padding bits) into a boolean mask of `n` entities """
+    return np.unpackbits(bitmap)[:n].view(bool)
+
+
+def union(bitmaps, rows, n):
+    """ Returns the union of the `rows` of the 2-d array `bitmaps` """
+    if len(rows) == 0:
+        return np.zeros((n + 7) // 8, dtype=np.uint8)
+    return np.bitwise_or.reduce(bitmaps[rows], axis=0)
+
+
+class Column(object):
+    """
+    All of the entities' cells at one keypath.  `present` masks the entities
+    that have the keypath.  The base class tests constraints one entity at a
+    time; subclasses vectorize the test for specific cell types.
+    """
+    def __init__(self, keypath, cells, n):
+        self.keypath = keypath
+        self.cells = cells  # entity index -> cell
+        self.present = np.zeros(n, dtype=bool)
+        self.present[cells.keys()] = True
+
+    @classmethod
+    def accepts(clz, cells):
+        """ Whether all of the column's cells can be stored by this class """
+        return True
+
+    def entailed(self, constraint, columns, where):
+        """ Returns a mask of the entities whose cell entails `constraint`.
+        Entities outside of the mask `where` may be skipped. """
+        mask = np.zeros(len(self.present), dtype=bool)
+        for i, cell in self.cells.iteritems():
+            if where[i]:
+                mask[i] = cell.entails(constraint)
+        return mask
+
+    def present_bitmap(self):
+        """ Returns the bitmap of the entities that have the keypath """
+        bitmap = self.__dict__.get('present_bits')
+        if bitmap is None:
+            bitmap = self.present_bits = pack(self.present)
+        return bitmap
+
+    def entailed_bitmap(self, constraint, columns):
+        """ Returns the bitmap of the entities that have the keypath and whose
+        cell entails `constraint`.  The base class packs `entailed()`. """
+        return pack(self.present & self.entailed(constraint, columns, self.present))
+
+    def export(self, writer):
+        """ Stores the column with `writer` (see `ColumnarDomain.export`).
+        The base class pickles its cells. """
+        writer.array('present', self.present)
+        writer.objects['cells'] = self.cells
+
+    @classmethod
+    def load(clz, keypath, reader):
+        """ Loads a column stored by `export()`; the columns that store their
+        cells as arrays rebuild them on demand (see `rebuild`) """
+        column = clz.__new__(clz)
+        column.keypath = keypath
+        column.present = reader.array('present')
+        if 'cells' in reader.objects:
+            column.cells = reader.objects['cells']
+        else:
+            column.cells = MappedCells(column, reader.columns)
+        return column
+
+    @staticmethod
+    def template(cell, **attributes):
+        """ Returns a shallow copy of `cell`, to rebuild cells of its class """
+        template = copy.copy(cell)
+        template.__dict__.update(attributes)
+        template.__dict__['_hash'] = None
+        template.__dict__['_fingerprint'] = None
+        return template
+
+
+class IntervalColumn(Column):
+    """
+    IntervalCells, stored as `low` and `high` arrays, and indexed by the
+    entities sorted by `low` (see `within`).
+    """
+
+    def __init__(self, keypath, cells, n):
+        Column.__init__(self, keypath, cells, n)
+        self.low = np.empty(n)
+        self.high = np.empty(n)
+        self.low.fill(np.nan)
+        self.high.fill(np.nan)
+        # entity indexes sorted by low, and their bounds in that order, built
+        # on demand
+        self.order = self.sorted_low = self.sorted_high = None
+        for i, cell in cells.iteritems():
+            self.low[i] = cell.low
+            self.high[i] = cell.high
+
+    @classmethod
+    def accepts(clz, cells):
+        return all(isinstance(c, IntervalCell) and _uses(c, 'entails', Cell) \
+                for c in cells.itervalues())
+
+    def entailed(self, constraint, columns, where):
+        if not (isinstance(constraint, IntervalCell) and \
+                _uses(constraint, 'is_entailed_by', IntervalCell)):
+            return Column.entailed(self, constraint, columns, where)
+        start, end = self.lower_bound_range(constraint.low, constraint.high)
+        if end - start > len(self.present) // 8:
+            # a comparison of every entity is faster than scattering many
+            # indexes; absent entities are NaN, which compare False
+            with np.errstate(invalid='ignore'):
+                return (self.low >= constraint.low) & (self.high <= constraint.high)
+        mask = np.zeros(len(self.present), dtype=bool)
+        mask[self.within(constraint.low, constraint.high)] = True
+        return mask
+
+    def sort(self):
+        """ Sorts the entities by `low`; absent entities (NaN) are sorted last """
+        if self.order is None:
+            self.order = np.argsort(self.low, kind='mergesort')
+            self.sorted_low = self.low[self.order]
+            self.sorted_high = self.high[self.order]
+
+    def within(self, low, high):
+        """
+        Returns the indexes of the entities whose interval lies within [low,
+        high].  Their lower bounds are in [low, high], which is a range of the
+        entities sorted by `low` found by binary search, so this takes
+        O(log n + k) for the k entities whose lower bound is in the range (all
+        of which are returned when the entities have single values).
+        """
+        start, end = self.lower_bound_range(low, high)
+        return self.order[start:end][self.sorted_high[start:end] <= high]
+
+    def lower_bound_range(self, low, high):
+        """ Returns the (start, end) range of the sorted entities whose lower
+        bound is in [low, high] """
+        self.sort()
+        return (np.searchsorted(self.sorted_low, low, 'left'),
+                np.searchsorted(self.sorted_low, high, 'right'))
+
+    def distinct_values(self, where):
+        """
+        Returns the sorted distinct values of the entities in the mask `where`,
+        or None if one of them is not a single value (low != high) or lacks
+        the keypath.  The entities are kept sorted by value, so this is a
+        single pass over them.
+        """
+        self.sort()
+        where = where[self.order]
+        low = self.sorted_low[where]
+        high = self.sorted_high[where]
+        if (low != high).any():
+            # includes NaN, which differs from itself
+            return None
+        if len(low) == 0:
+            return low
+        return low[np.concatenate(([True], low[1:] != low[:-1]))]
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        writer.array('low', self.low)
+        writer.array('high', self.high)
+        self.sort()
+        for name in ['order', 'sorted_low', 'sorted_high']:
+            writer.array(name, getattr(self, name))
+        writer.objects['template'] = self.template(self.cells.itervalues().next())
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(IntervalColumn, clz).load(keypath, reader)
+        column.low = reader.array('low')
+        column.high = reader.array('high')
+        for name in ['order', 'sorted_low', 'sorted_high']:
+            setattr(column, name, reader.array(name))
+        column.prototype = reader.objects['template']
+        return column
+
+    def rebuild(self, i, columns):
+        """ Rebuilds the cell of entity `i` of a loaded column """
+        return self.template(self.prototype, low=float(self.low[i]), high=float(self.high[i]))
+
+
+class CategoricalColumn(Column):
+    """
+    Cells whose entailment depends only on their class and value, such as
+    BoolCells and StringCells.  Each distinct value is stored once, as a
+    representative cell, and entities store the code of their value.
+    `postings` holds the bitmap of the entities of each code.
+    """
+    def __init__(self, keypath, cells, n):
+        Column.__init__(self, keypath, cells, n)
+        self.codes = np.empty(n, dtype=np.int32)
+        self.codes.fill(-1)
+        self.representatives = []
+        vocabulary = {}
+        for i, cell in cells.iteritems():
+            key = self.category(cell)
+            if key not in vocabulary:
+                vocabulary[key] = len(self.representatives)
+                self.representatives.append(cell)
+            self.codes[i] = vocabulary[key]
+        self.postings = np.array([pack(self.codes == code) \
+                for code in xrange(len(self.representatives))], dtype=np.uint8)
+
+    @classmethod
+    def accepts(clz, cells):
+        # BoolCell's entails is Cell's, after coercing the other cell
+        return all(isinstance(c, (BoolCell, StringCell)) and \
+                (_uses(c, 'entails', Cell) or _uses(c, 'entails', BoolCell)) \
+                for c in cells.itervalues())
+
+    @staticmethod
+    def category(cell):
+        """ The cells of a category are equal, so one of them represents it """
+        return (type(cell), cell.value)
+
+    def entailed(self, constraint, columns, where):
+        # one test per distinct value; index -1 (absent) maps to False
+        table = [rep.entails(constraint) for rep in self.representatives]
+        table = np.array(table + [False], dtype=bool)
+        return table[self.codes]
+
+    def entailed_bitmap(self, constraint, columns):
+        # one test per distinct value, and the union of their postings
+        codes = [code for code, rep in enumerate(self.representatives) \
+                if rep.entails(constraint)]
+        return union(self.postings, codes, len(self.present))
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        writer.array('codes', self.codes)
+        writer.array('postings', self.postings)
+        writer.meta['values'] = [writer.value(rep.value) for rep in self.representatives]
+        writer.objects['templates'] = [self.template(rep, value=None) \
+                for rep in self.representatives]
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(CategoricalColumn, clz).load(keypath, reader)
+        column.codes = reader.array('codes')
+        column.postings = reader.array('postings')
+        column.representatives = [clz.template(template, value=reader.value(value)) \
+                for template, value in zip(reader.objects['templates'], reader.meta['values'])]
+        return column
+
+    def rebuild(self, i, columns):
+        return self.template(self.representatives[self.codes[i]])
+
+
+class OrderedColumn(CategoricalColumn):
+    """ LinearOrderedCells, whose categories are their domain and bounds """
+
+    @classmethod
+    def accepts(clz, cells):
+        return all(isinstance(c, LinearOrderedCell) and _uses(c, 'entails', Cell) \
+                for c in cells.itervalues())
+
+    @staticmethod
+    def category(cell):
+        return (type(cell), tuple(cell.domain), cell.low, cell.high)
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        writer.array('codes', self.codes)
+        writer.array('postings', self.postings)
+        writer.meta['domains'] = [[writer.value(value) for value in rep.domain] \
+                for rep in self.representatives]
+        writer.meta['bounds'] = [[writer.value(rep.low), writer.value(rep.high)] \
+                for rep in self.representatives]
+        writer.objects['templates'] = [self.template(rep, domain=None, low=None, high=None) \
+                for rep in self.representatives]
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(CategoricalColumn, clz).load(keypath, reader)
+        column.codes = reader.array('codes')
+        column.postings = reader.array('postings')
+        column.representatives = []
+        domains = {}
+        for template, domain, (low, high) in zip(reader.objects['templates'],
+                reader.meta['domains'], reader.meta['bounds']):
+            domain = [reader.value(value) for value in domain]
+            # representatives with the same domain share it
+            domain = domains.setdefault(tuple(domain), domain)
+            column.representatives.append(clz.template(template, domain=domain,
+                low=reader.value(low), high=reader.value(high)))
+        return column
+
+
+class PosetColumn(CategoricalColumn):
+    """
+    PartialOrderedCells, such as the 'kind' TaxonomyCell of Referents.  The
+    entities whose cell is a single kind (one upper bound and no lower bound)
+    are also indexed by taxonomy node: `kinds` maps every node to the bitmap
+    of the entities whose kind is that node or one of its descendants.
+    """
+
+    @classmethod
+    def accepts(clz, cells):
+        return all(isinstance(c, PartialOrderedCell) and _uses(c, 'entails', Cell) \
+                for c in cells.itervalues())
+
+    @staticmethod
+    def category(cell):
+        return (type(cell), frozenset(cell.upper), frozenset(cell.lower))
+
+    def index(self):
+        """ Builds `kinds`, for the single kinds of the taxonomy of the first
+        one; the codes of the other cells are kept in `others` """
+        n = len(self.present)
+        self.kinds = {}
+        self.others = []
+        self.taxonomy = None
+        for code, rep in enumerate(self.representatives):
+            if len(rep.upper) == 1 and not rep.lower:
+                if self.taxonomy is None:
+                    self.taxonomy = rep.get_domain()
+                if rep.get_domain() is self.taxonomy:
+                    kind, = rep.upper
+                    if isinstance(self.taxonomy, CompiledTaxonomy):
+                        ancestors = self.taxonomy.ancestors(kind)
+                    else:
+                        ancestors = nx.ancestors(self.taxonomy, kind)
+                    for node in ancestors | set([kind]):
+                        self.kinds[node] = self.kinds.get(node, 0) | self.postings[code]
+                    continue
+            self.others.append(code)
+        self.all_kinds = union(self.postings, [code for code in \
+                xrange(len(self.representatives)) if code not in self.others], n)
+
+    def entailed(self, constraint, columns, where):
+        return unpack(self.entailed_bitmap(constraint, columns), len(self.present))
+
+    def entailed_bitmap(self, constraint, columns):
+        """
+        A constraint without lower bounds whose upper bound is a single node
+        (or is empty) is entailed by the single kinds that are that node or its
+        descendants (or by all of them), which is one lookup in `kinds`.  The
+        other cells, and the other constraints, are tested once per distinct
+        value.
+        """
+        if self.__dict__.get('kinds') is None:
+            self.index()
+        if not (isinstance(constraint, PartialOrderedCell) and \
+                _uses(constraint, 'is_entailed_by', PartialOrderedCell) and \
+                self.taxonomy is not None and constraint.get_domain() is self.taxonomy and \
+                not constraint.lower and (not constraint.upper or \
+                (len(constraint.upper) == 1 and constraint.compute_upper_bound() == constraint.upper))):
+            return CategoricalColumn.entailed_bitmap(self, constraint, columns)
+        n = len(self.present)
+        if constraint.upper:
+            node, = constraint.upper
+            bitmap = self.kinds.get(node)
+            if bitmap is None:
+                bitmap = np.zeros((n + 7) // 8, dtype=np.uint8)
+        else:
+            bitmap = self.all_kinds
+        others = [code for code in self.others \
+                if self.representatives[code].entails(constraint)]
+        return bitmap | union(self.postings, others, n)
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        writer.array('codes', self.codes)
+        writer.array('postings', self.postings)
+        writer.objects['representatives'] = self.representatives
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(CategoricalColumn, clz).load(keypath, reader)
+        column.codes = reader.array('codes')
+        column.postings = reader.array('postings')
+        column.representatives = reader.objects['representatives']
+        return column
+
+    def rebuild(self, i, columns):
+        rep = self.representatives[self.codes[i]]
+        # the bounds are sets, which the entity must not share
+        return self.template(rep, upper=set(rep.upper), lower=set(rep.lower))
+
+
+class SetColumn(Column):
+    """
+    SetIntersectionCells, stored as a membership matrix over the vocabulary of
+    values and a code for each distinct domain.
+    """
+    def __init__(self, keypath, cells, n):
+        Column.__init__(self, keypath, cells, n)
+        self.vocabulary = {}
+        self.domains = []
+        domain_codes = {}
+        self.domain_codes = np.empty(n, dtype=np.int32)
+        self.domain_codes.fill(-1)
+        self.has_values = np.zeros(n, dtype=bool)
+        self.has_set = np.zeros(n, dtype=bool)  # values is not None
+        for cell in cells.itervalues():
+            for value in (cell.values or ()):
+                self.vocabulary.setdefault(value, len(self.vocabulary))
+        self.members = np.zeros((n, len(self.vocabulary)), dtype=bool)
+        for i, cell in cells.iteritems():
+            domain = frozenset(cell.domain)
+            if domain not in domain_codes:
+                domain_codes[domain] = len(self.domains)
+                self.domains.append(domain)
+            self.domain_codes[i] = domain_codes[domain]
+            if cell.values is not None:
+                self.has_set[i] = True
+            if cell.values:
+                self.has_values[i] = True
+                self.members[i, [self.vocabulary[v] for v in cell.values]] = True
+        self.index()
+
+    def index(self):
+        """ Builds the bitmaps of the entities that have each value
+        (`postings`), that have each domain and that have values """
+        self.postings = np.array([pack(self.members[:, j]) \
+                for j in xrange(self.members.shape[1])], dtype=np.uint8)
+        self.domain_postings = np.array([pack(self.domain_codes == code) \
+                for code in xrange(len(self.domains))], dtype=np.uint8)
+        self.has_values_bits = pack(self.has_values)
+
+    @classmethod
+    def accepts(clz, cells):
+        return all(isinstance(c, SetIntersectionCell) and _uses(c, 'entails', Cell) \
+                for c in cells.itervalues())
+
+    def entailed(self, constraint, columns, where):
+        if not (isinstance(constraint, SetIntersectionCell) and \
+                _uses(constraint, 'is_entailed_by', SetIntersectionCell)):
+            return Column.entailed(self, constraint, columns, where)
+        domain = frozenset(constraint.domain)
+        same_domain = np.array([d == domain for d in self.domains] + [False])
+        mask = same_domain[self.domain_codes]
+        if constraint.values:
+            # entities without values, or with values outside of the
+            # constraint's, are not entailed
+            outside = [j for v, j in self.vocabulary.iteritems() \
+                    if v not in constraint.values]
+            mask &= self.has_values
+            if outside:
+                mask &= ~self.members[:, outside].any(axis=1)
+        return mask
+
+    def entailed_bitmap(self, constraint, columns):
+        if not (isinstance(constraint, SetIntersectionCell) and \
+                _uses(constraint, 'is_entailed_by', SetIntersectionCell)):
+            return Column.entailed_bitmap(self, constraint, columns)
+        n = len(self.present)
+        domain = frozenset(constraint.domain)
+        bitmap = union(self.domain_postings,
+                [code for code, d in enumerate(self.domains) if d == domain], n)
+        if constraint.values:
+            bitmap &= self.has_values_bits
+            outside = [j for v, j in self.vocabulary.iteritems() \
+                    if v not in constraint.values]
+            bitmap &= ~union(self.postings, outside, n)
+        return bitmap
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        for name in ['members', 'domain_codes', 'has_values', 'has_set', 'postings',
+                     'domain_postings', 'has_values_bits']:
+            writer.array(name, getattr(self, name))
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        writer.meta['vocabulary'] = [writer.value(value) for value in vocabulary]
+        writer.meta['domains'] = [[writer.value(value) for value in domain] \
+                for domain in self.domains]
+        writer.objects['template'] = self.template(self.cells.itervalues().next(),
+                domain=None, values=None)
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(SetColumn, clz).load(keypath, reader)
+        for name in ['members', 'domain_codes', 'has_values', 'has_set', 'postings',
+                     'domain_postings', 'has_values_bits']:
+            setattr(column, name, reader.array(name))
+        column.values = [reader.value(value) for value in reader.meta['vocabulary']]
+        column.vocabulary = dict((value, j) for j, value in enumerate(column.values))
+        column.domains = [frozenset(reader.value(value) for value in domain) \
+                for domain in reader.meta['domains']]
+        column.prototype = reader.objects['template']
+        return column
+
+    def rebuild(self, i, columns):
+        values = None
+        if self.has_set[i]:
+            values = set(self.values[j] for j in np.flatnonzero(self.members[i]))
+        return self.template(self.prototype, domain=set(self.domains[self.domain_codes[i]]),
+                values=values)
+
+
+class DictColumn(Column):
+    """ Nested DictCells, whose parts are stored in their own columns """
+
+    @classmethod
+    def accepts(clz, cells):
+        return all(isinstance(c, DictCell) and _uses(c, 'entails', DictCell) \
+                for c in cells.itervalues())
+
+    def entailed(self, constraint, columns, where):
+        if not (isinstance(constraint, DictCell) and \
+                _uses(constraint, 'is_entailed_by', DictCell)):
+            return Column.entailed(self, constraint, columns, where)
+        return self.present & columns.dict_mask(constraint, self.keypath)
+
+    def export(self, writer):
+        writer.array('present', self.present)
+        writer.objects['template'] = self.template(self.cells.itervalues().next(), p=None)
+
+    @classmethod
+    def load(clz, keypath, reader):
+        column = super(DictColumn, clz).load(keypath, reader)
+        column.prototype = reader.objects['template']
+        return column
+
+    def rebuild(self, i, columns):
+        return columns.rebuild_dict(self.prototype, self.keypath, i)
+
+
+class MappedCells(object):
+    """ The cells of a loaded column, keyed by entity index, which are rebuilt
+    from its arrays on access """
+    def __init__(self, column, columns):
+        self.column = column
+        self.columns = columns
+
+    def __getitem__(self, i):
+        if not self.column.present[i]:
+            raise KeyError(i)
+        return self.column.rebuild(i, self.columns)
+
+    def __contains__(self, i):
+        return bool(self.column.present[i])
+
+    def __len__(self):
+        return int(self.column.present.sum())
+
+    def keys(self):
+        return list(np.flatnonzero(self.column.present))
+
+    def iteritems(self):
+        for i in np.flatnonzero(self.column.present):
+            yield i, self[i]
+
+    def itervalues(self):
+        for _, cell in self.iteritems():
+            yield cell
+
+
+class MappedEntities(object):
+    """ The entities of a loaded ColumnarDomain, rebuilt on access and kept
+    for as long as they are used """
+    def __init__(self, columns):
+        self.columns = columns
+        self.cache = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return self.columns.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        entity = self.cache.get(i)
+        if entity is None:
+            entity = self.columns.rebuild_entity(i)
+            self.cache[i] = entity
+        return entity
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+class SchemaIndex(object):
+    """
+    The keypaths of the entities that have the same keypaths as `entity`, in
+    the depth-first order (by sorted attribute name) that
+    `BeliefState.find_path` visits them, indexed by attribute name and by the
+    attributes of the DictCells at each keypath.
+    """
+    def __init__(self, entity):
+        self.paths = []    # keypath tuples, depth-first
+        self.parents = []  # index of each keypath's parent in paths, or -1
+        self.keys = {}     # keypath of a DictCell -> frozenset of its attributes
+        self.by_name = {}  # attribute name -> keypaths
+        self.attribute_sets = {}  # frozenset of attributes -> keypaths
+        self.index(entity, (), -1)
+        self.parts = [path for path in self.paths if path in self.keys]
+
+    def index(self, cell, prefix, parent):
+        for name, structure in cell:
+            path = prefix + (name,)
+            self.paths.append(path)
+            self.parents.append(parent)
+            self.by_name.setdefault(name, []).append(path)
+            if isinstance(structure, DictCell):
+                self.keys[path] = frozenset(structure.__dict__['p'])
+                self.index(structure, path, len(self.paths) - 1)
+
+    def iter_parts(self, entity):
+        """ Generates (keypath, cell) for every part of `entity`, depth-first """
+        cells = []
+        for path, parent in itertools.izip(self.paths, self.parents):
+            container = entity if parent < 0 else cells[parent]
+            cell = container.__dict__['p'][path[-1]]
+            cells.append(cell)
+            yield path, cell
+
+    def paths_for_attribute(self, name):
+        """ Returns the keypaths whose last attribute is `name` """
+        return self.by_name.get(name, [])
+
+    def paths_for_attribute_set(self, keys):
+        """ Returns the keypaths of the DictCells that have all of `keys` """
+        keys = frozenset(keys)
+        paths = self.attribute_sets.get(keys)
+        if paths is None:
+            if keys:
+                paths = [path for path in self.parts if keys <= self.keys[path]]
+            else:
+                paths = self.paths
+            self.attribute_sets[keys] = paths
+        return paths
+
+
+class ColumnarDomain(object):
+    """
+    Mirrors the cells of every entity in a referential domain, keyed by
+    keypath (a tuple of attribute names), as Columns.  The referential domain
+    is assumed to be read-only, and its i-th entity to have the 'num' i, which
+    is checked when the columns are built (but not when they are loaded, as
+    they were checked before they were exported).
+    """
+    COLUMN_CLASSES = [IntervalColumn, CategoricalColumn, OrderedColumn, PosetColumn,
+                      SetColumn, DictColumn]
+    _instances = weakref.WeakValueDictionary()
+
+    def __init__(self, referential_domain):
+        self.referential_domain = referential_domain
+        self.entities = list(referential_domain.iter_entities())
+        self.size = len(self.entities)
+        cells_by_keypath = {}
+        for i, entity in enumerate(self.entities):
+            if entity['num'] != i:
+                raise Exception("%ith entity in referential domain does not have 'num' property set correctly" % i)
+            for keypath, cell in self.iter_keypaths(entity):
+                cells_by_keypath.setdefault(keypath, {})[i] = cell
+        self.columns = {}
+        for keypath, cells in cells_by_keypath.iteritems():
+            self.columns[keypath] = self.build_column(keypath, cells)
+        self.schemas = {}  # entity class, or frozenset of keypaths -> SchemaIndex
+        self.uniform_classes = {}  # entity class -> whether its entities share keypaths
+        self.content_fingerprint = None
+        self.register_domains()
+
+    @classmethod
+    def for_domain(clz, referential_domain):
+        """ Returns the ColumnarDomain of `referential_domain`, building it
+        only if no BeliefState currently shares one for that domain. """
+        columns = clz._instances.get(id(referential_domain))
+        if columns is None or columns.referential_domain is not referential_domain:
+            columns = clz(referential_domain)
+            clz._instances[id(referential_domain)] = columns
+        return columns
+
+    @staticmethod
+    def iter_keypaths(cell, prefix=()):
+        """ Generates (keypath, cell) for every part of a DictCell, recursively """
+        for key, value in cell.__dict__['p'].iteritems():
+            keypath = prefix + (key,)
+            yield keypath, value
+            if isinstance(value, DictCell):
+                for entry in ColumnarDomain.iter_keypaths(value, keypath):
+                    yield entry
+
+    def schema(self, entity):
+        """ Returns the SchemaIndex of `entity`, which is shared by the entities
+        of its class if they all have the same keypaths, and otherwise by the
+        entities that have the same keypaths """
+        key = type(entity)
+        if not self.is_uniform_class(key):
+            key = frozenset(keypath for keypath, _ in self.iter_keypaths(entity))
+        schema = self.schemas.get(key)
+        if schema is None:
+            schema = SchemaIndex(entity)
+            self.schemas[key] = schema
+        return schema
+
+    def is_uniform_class(self, entity_class):
+        """ Whether all entities of `entity_class` have the same keypaths, which
+        is found from the columns rather than by walking the entities """
+        uniform = self.uniform_classes.get(entity_class)
+        if uniform is None:
+            if isinstance(self.entities, MappedEntities):
+                codes = [code for code, template in enumerate(self.entity_templates) \
+                        if type(template) is entity_class]
+                mask = np.in1d(self.entity_classes, codes)
+            else:
+                mask = np.array([type(entity) is entity_class for entity in self.entities],
+                        dtype=bool)
+            uniform = True
+            for column in self.columns.itervalues():
+                present = column.present[mask]
+                if present.any() and not present.all():
+                    uniform = False
+                    break
+            self.uniform_classes[entity_class] = uniform
+        return uniform
+
+    def fingerprint(self):
+        """ Returns the fingerprint of the entities (see Cell.fingerprint),
+        which identifies the referential domain in every process """
+        if self.content_fingerprint is None:
+            self.content_fingerprint = fingerprints.fingerprint(
+                    [entity.fingerprint() for entity in self.entities])
+        return self.content_fingerprint
+
+    def invalidate_schemas(self):
+        """ Discards the SchemaIndexes, after the attributes of the entities
+        have changed """
+        self.schemas.clear()
+        self.uniform_classes.clear()
+
+    def export(self, path):
+        """
+        Stores the columns in the directory `path`: every array as a .npy file,
+        the metadata and the interned strings in 'domain.json', and the objects
+        that have no columnar form (cell templates and the cells of unvectorized
+        columns) in 'objects.pickle'.  See MappedDomain.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        writer = DomainWriter(path)
+        columns = []
+        for index, (keypath, column) in enumerate(sorted(self.columns.iteritems())):
+            writer.start(index)
+            column.export(writer)
+            columns.append({'keypath': list(keypath), 'class': column.__class__.__name__,
+                            'meta': writer.meta})
+        writer.start('entities')
+        classes = []
+        codes = np.empty(self.size, dtype=np.int32)
+        for i, entity in enumerate(self.entities):
+            if type(entity) not in classes:
+                classes.append(type(entity))
+                writer.objects.setdefault('templates', []).append(Column.template(entity, p=None))
+            codes[i] = classes.index(type(entity))
+        writer.array('classes', codes)
+        writer.close({'size': self.size, 'columns': columns,
+                      'fingerprint': self.fingerprint()})
+
+    @classmethod
+    def load(clz, path, referential_domain):
+        """ Loads the columns stored by `export()`, memory-mapping their arrays """
+        reader = DomainReader(path)
+        columns = clz.__new__(clz)
+        columns.referential_domain = referential_domain
+        columns.size = reader.size
+        columns.columns = {}
+        columns.children = {}  # keypath prefix -> keypaths of its parts
+        columns.schemas = {}
+        columns.uniform_classes = {}
+        columns.content_fingerprint = reader.info.get('fingerprint')
+        reader.columns = columns
+        classes = dict((c.__name__, c) for c in clz.COLUMN_CLASSES + [Column])
+        for index, entry in enumerate(reader.info['columns']):
+            keypath = tuple(reader.intern(key) for key in entry['keypath'])
+            reader.start(index, entry['meta'])
+            columns.columns[keypath] = classes[entry['class']].load(keypath, reader)
+            columns.children.setdefault(keypath[:-1], []).append(keypath)
+        reader.start('entities', {})
+        columns.entity_classes = reader.array('classes')
+        columns.entity_templates = reader.objects['templates']
+        columns.entities = MappedEntities(columns)
+        columns.register_domains()
+        return columns
+
+    def register_domains(self):
+        """ Registers the domains of the cells, so that cells pickled by other
+        processes with the same domains can be unpickled (see cells.registry) """
+        for column in self.columns.itervalues():
+            if isinstance(column, SetColumn):
+                for domain in column.domains:
+                    registry.domain_key(domain)
+            elif isinstance(column, OrderedColumn):
+                for rep in column.representatives:
+                    registry.domain_key(rep.domain)
+            elif type(column) is Column:
+                for cell in column.cells.itervalues():
+                    if isinstance(cell, (SetIntersectionCell, LinearOrderedCell)):
+                        registry.domain_key(cell.domain)
+
+    def rebuild_dict(self, prototype, prefix, i):
+        """ Rebuilds the DictCell of entity `i` at keypath `prefix` of a loaded
+        ColumnarDomain, from the template `prototype` """
+        cell = Column.template(prototype, p={})
+        for keypath in self.children.get(prefix, []):
+            column = self.columns[keypath]
+            if column.present[i]:
+                cell.__dict__['p'][keypath[-1]] = cell._adopt(column.cells[i])
+        return cell
+
+    def rebuild_entity(self, i):
+        """ Rebuilds entity `i` of a loaded ColumnarDomain """
+        return self.rebuild_dict(self.entity_templates[self.entity_classes[i]], (), i)
+
+    def build_column(self, keypath, cells):
+        """ Stores `cells` in the first column class that accepts all of them """
+        for column_class in self.COLUMN_CLASSES:
+            if column_class.accepts(cells):
+                return column_class(keypath, cells, self.size)
+        return Column(keypath, cells, self.size)
+
+    def part_mask(self, keypath, cell):
+        """ Returns a boolean mask of the entities that have `keypath` and whose
+        cell there entails `cell` """
+        return unpack(self.part_bitmap(keypath, cell), self.size)
+
+    def part_bitmap(self, keypath, cell):
+        """ Returns `part_mask()` as a bitmap (see `pack()`) """
+        column = self.columns.get(keypath)
+        if column is None:
+            return np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        return column.entailed_bitmap(cell, self)
+
+    def mask(self, constraint):
+        """ Returns a boolean mask of the entities that entail the DictCell
+        `constraint`, i.e., where `constraint.is_entailed_by(entity)` """
+        return self.dict_mask(constraint, ())
+
+    def dict_mask(self, constraint, prefix):
+        """ Returns the mask of entities that entail the DictCell `constraint`,
+        which is found at keypath `prefix` """
+        mask = np.ones(self.size, dtype=bool)
+        for key, value in constraint.__dict__['p'].iteritems():
+            column = self.columns.get(prefix + (key,))
+            if column is None:
+                # no entity has the attribute
+                return np.zeros(self.size, dtype=bool)
+            mask &= column.present
+            mask &= column.entailed(value, self, mask)
+            if not mask.any():
+                break
+        return mask
+
+
+class DomainWriter(object):
+    """ Stores the arrays, strings and objects of the columns of a ColumnarDomain
+    (see `ColumnarDomain.export`) """
+
+    def __init__(self, path):
+        self.path = path
+        self.strings = {}
+        self.all_objects = {}
+        self.prefix = None
+
+    def start(self, prefix):
+        """ Starts storing the column (or part) named `prefix` """
+        self.prefix = prefix
+        self.meta = {}
+        self.objects = self.all_objects.setdefault(prefix, {})
+
+    def array(self, name, array):
+        np.save(os.path.join(self.path, "%s.%s.npy" % (self.prefix, name)), array)
+
+    def value(self, value):
+        """ Encodes a value for JSON, replacing strings by their index in the
+        string table """
+        if isinstance(value, basestring):
+            return ['s', self.strings.setdefault(value, len(self.strings))]
+        return ['v', value]
+
+    def close(self, meta):
+        meta['strings'] = sorted(self.strings, key=self.strings.get)
+        with open(os.path.join(self.path, 'domain.json'), 'w') as out:
+            json.dump(meta, out)
+        with open(os.path.join(self.path, 'objects.pickle'), 'wb') as out:
+            pickle.dump(self.all_objects, out, pickle.HIGHEST_PROTOCOL)
+
+
+class DomainReader(object):
+    """ Loads what a DomainWriter stored, memory-mapping the arrays """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'domain.json')) as source:
+            self.info = json.load(source)
+        with open(os.path.join(path, 'objects.pickle'), 'rb') as source:
+            self.all_objects = pickle.load(source)
+        self.size = self.info['size']
+        self.strings = [self.intern(string) for string in self.info['strings']]
+
+    @staticmethod
+    def intern(string):
+        """ JSON strings are unicode; ASCII ones are interned as str """
+        try:
+            return intern(string.encode('ascii'))
+        except UnicodeEncodeError:
+            return string
+
+    def start(self, prefix, meta):
+        self.prefix = prefix
+        self.meta = meta
+        self.objects = self.all_objects.get(prefix, {})
+
+    def array(self, name):
+        filename = os.path.join(self.path, "%s.%s.npy" % (self.prefix, name))
+        try:
+            return np.load(filename, mmap_mode='r')
+        except ValueError:
+            # empty arrays cannot be mapped
+            return np.load(filename)
+
+    def value(self, encoded):
+        kind, value = encoded
+        if kind == 's':
+            return self.strings[value]
+        return value
+
+
+class MappedDomain(object):
+    """
+    A referential domain exported by `ColumnarDomain.export()`.  Its columns are
+    memory-mapped, so processes that open the same directory share them, and
+    its entities are rebuilt from the columns when they are accessed.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        # unpickled beliefstates share the domain of the same path
+        self.registry_key = 'mapped:' + self.path
+        self.columns = ColumnarDomain.load(path, self)
+        ColumnarDomain._instances[id(self)] = self.columns
+        registry.object_key(self)
+
+    def __reduce__(self):
+        """ A MappedDomain is pickled as its path """
+        return (open_mapped_domain, (self.path,))
+
+    def iter_entities(self):
+        return iter(self.columns.entities)
+
+    def __len__(self):
+        return self.columns.size
+
+
+def open_mapped_domain(path):
+    """ Returns the MappedDomain of `path` that this process opened, or opens it """
+    domain = registry.lookup('mapped:' + os.path.abspath(path))
+    if domain is None:
+        domain = MappedDomain(path)
+    return domain
@@ -0,0 +1,102 @@
+"""
+Deferred effects of a BeliefState, indexed by the part of speech that
+triggers them.
+"""
+import heapq
+from collections import deque
+
+
+class DeferredEffects(object):
+    """
+    The (pos, effect) pairs waiting for the beliefstate to reach a part of
+    speech that starts with `pos`.
+
+    Effects are kept in one deque per trigger `pos`, ordered by a sequence
+    number: pushed (stacked) effects get decreasing numbers and appended
+    (queued) effects increasing ones, so that iterating over all of the
+    deques in sequence order gives the same order as a single list where
+    stacked effects are inserted at the front and queued ones at the end.
+
+    Only the prefixes of a part of speech can trigger effects, so finding
+    and removing the triggered effects costs O(len(pos)) lookups plus the
+    number of triggered effects.
+    """
+
+    def __init__(self, entries=()):
+        self.by_pos = {}  # trigger pos -> deque of (sequence, pos, effect)
+        self.first = 0    # sequence number of the front of the list
+        self.last = 0     # sequence number after the end of the list
+        self.length = 0
+        for pos, effect in entries:
+            self.append(pos, effect)
+
+    def push(self, pos, effect):
+        """ Adds an effect in front of all the others (stacked syntax) """
+        self.first -= 1
+        self.by_pos.setdefault(pos, deque()).appendleft((self.first, pos, effect))
+        self.length += 1
+
+    def append(self, pos, effect):
+        """ Adds an effect after all the others (queued syntax) """
+        self.by_pos.setdefault(pos, deque()).append((self.last, pos, effect))
+        self.last += 1
+        self.length += 1
+
+    def pop_triggered(self, pos):
+        """ Removes the effects triggered by `pos`, i.e. those whose pos is a
+        prefix of `pos`, and returns them in order, as a list of (sequence,
+        pos, effect) entries that `restore()` can put back """
+        triggered = []
+        for i in xrange(len(pos) + 1):
+            entries = self.by_pos.pop(pos[:i], None)
+            if entries is not None:
+                triggered.append(entries)
+        if not triggered:
+            return []
+        if len(triggered) == 1:
+            entries = triggered[0]
+        else:
+            # sequence numbers are unique, so effects are never compared
+            entries = list(heapq.merge(*triggered))
+        self.length -= len(entries)
+        return list(entries)
+
+    def restore(self, entries):
+        """ Puts back entries returned by `pop_triggered()`, in their places """
+        by_trigger = {}
+        for entry in entries:
+            by_trigger.setdefault(entry[1], []).append(entry)
+        for pos, restored in by_trigger.iteritems():
+            existing = self.by_pos.get(pos)
+            if existing is None:
+                self.by_pos[pos] = deque(restored)
+            else:
+                # sequence numbers are unique, so effects are never compared
+                self.by_pos[pos] = deque(heapq.merge(existing, restored))
+            self.length += len(restored)
+
+    def copy(self):
+        """ Copies the index, but not the effects """
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.by_pos = dict((pos, deque(entries)) for pos, entries in self.by_pos.iteritems())
+        return copied
+
+    def __iter__(self):
+        entries = sorted(entry for entries in self.by_pos.itervalues() for entry in entries)
+        for (_, pos, effect) in entries:
+            yield (pos, effect)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        if not isinstance(other, DeferredEffects):
+            return list(self) == other
+        return self.length == other.length and list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "DeferredEffects(%r)" % (list(self),)
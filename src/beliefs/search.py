@@ -0,0 +1,358 @@
+"""
+Helpers for searching over BeliefState transitions.
+
+Many different sequences of actions reach the same beliefstate (for instance,
+merging a plural constraint and then 'yellow', or 'yellow' and then the
+plural constraint).  A TranspositionTable remembers the beliefstates that a
+search has already expanded, so that a search can detect such duplicates and
+reuse the first (canonical) instance, its size and its cost:
+
+    >> table = TranspositionTable(capacity=10000)
+    >> entry = table.lookup(successor)
+    >> if entry is None or cost < entry.cost:
+    >>     entry = table.store(successor, cost)
+    >>     ...expand successor...
+
+ParallelSearch spreads a best-first search over worker processes, in the
+style of Hash Distributed A* (HDA*): every beliefstate is owned by the worker
+that its fingerprint is assigned to, so each worker detects the duplicates of
+its own partition with its own TranspositionTable.
+"""
+import heapq
+import itertools
+import multiprocessing
+import Queue
+from collections import OrderedDict
+from beliefs.cells import DictCell
+from beliefs.cells import registry
+from beliefs.columns import MappedDomain
+
+
+def same_beliefstate(state, other):
+    """
+    Returns True iff the two beliefstates are structurally equal: they have the
+    same part of speech, environment variables, deferred effects and cells.
+    Unlike `BeliefState.is_equal`, this does not rely on hash values alone.
+    """
+    if state is other:
+        return True
+    for key in ['pos', 'environment_variables', 'deferred_effects']:
+        if state.__dict__[key] != other.__dict__[key]:
+            return False
+    return DictCell.is_equal(state, other)
+
+
+class TranspositionEntry(object):
+    """ The canonical instance of an expanded beliefstate, its size and its
+    (lowest known) cost """
+    __slots__ = ['state', 'size', 'cost']
+
+    def __init__(self, state, size, cost):
+        self.state = state
+        self.size = size
+        self.cost = cost
+
+    def __repr__(self):
+        return "TranspositionEntry(size=%r, cost=%r)" % (self.size, self.cost)
+
+
+class TranspositionTable(object):
+    """
+    A bounded table of expanded beliefstates, keyed by their identity: their
+    hash value plus structural equality, so that hash collisions do not merge
+    distinct beliefstates.  When the table holds more than `capacity`
+    beliefstates, the least recently used ones are evicted.
+    """
+
+    def __init__(self, capacity=100000):
+        if capacity < 1:
+            raise ValueError("Capacity must be positive")
+        self.capacity = capacity
+        self.buckets = OrderedDict()  # hash -> [TranspositionEntry], LRU first
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _find(self, state):
+        """ Returns the entry of a beliefstate equal to `state` (marking it as
+        recently used) or None """
+        key = hash(state)
+        bucket = self.buckets.get(key)
+        if bucket is not None:
+            for entry in bucket:
+                if same_beliefstate(entry.state, state):
+                    # move the bucket to the most recently used end
+                    del self.buckets[key]
+                    self.buckets[key] = bucket
+                    return entry
+        return None
+
+    def lookup(self, state):
+        """
+        Returns the TranspositionEntry of a beliefstate equal to `state` (with the
+        canonical instance, its cached size() and its cost) or None if it has not
+        been stored.  Counts towards the hit rate.
+        """
+        entry = self._find(state)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def store(self, state, cost, size=None):
+        """
+        Records `state`, reached with `cost`, and returns its TranspositionEntry.
+        If an equal beliefstate is already stored, it remains the canonical
+        instance and only its cost is lowered to `cost`.  `size` defaults to
+        `state.size()`, which is computed once per canonical instance.
+        """
+        entry = self._find(state)
+        if entry is not None:
+            entry.cost = min(entry.cost, cost)
+            return entry
+        if size is None:
+            size = state.size()
+        entry = TranspositionEntry(state, size, cost)
+        self.buckets.setdefault(hash(state), []).append(entry)
+        self.entries += 1
+        while self.entries > self.capacity:
+            _, evicted = self.buckets.popitem(last=False)
+            self.entries -= len(evicted)
+            self.evictions += len(evicted)
+        return entry
+
+    def hit_rate(self):
+        """ Returns the fraction of lookups that found a stored beliefstate """
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+    def stats(self):
+        """ Returns the table's instrumentation counters """
+        return {'entries': self.entries,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate(),
+                'evictions': self.evictions}
+
+    def clear(self):
+        """ Removes all entries, but keeps the counters """
+        self.buckets.clear()
+        self.entries = 0
+
+    def __len__(self):
+        return self.entries
+
+    def __contains__(self, state):
+        return self._find(state) is not None
+
+
+class ParallelSearch(object):
+    """
+    A best-first (A*) search over beliefstates, run by `workers` processes
+    that partition the beliefstates by hash value (HDA*).
+
+    `expand(state)` returns (successor, step cost) pairs, `is_goal(state)`
+    tests for goals, and the optional `heuristic(state)` estimates the cost
+    to a goal, which must not be an overestimate for the result to be optimal.
+    Workers are forked, so these functions need not be picklable, and they
+    share the (read-only) referential domain and its columns.  Alternatively,
+    with `domain_path`, workers open the domain that `ColumnarDomain.export()`
+    stored there as a MappedDomain, instead of using the forked one.  Beliefstates
+    are pickled between workers in batches of `batch_size`, with the
+    referential domain, which every worker registers under the same key (see
+    cells.registry), pickled as that key; deferred effects, for instance, must
+    be module-level functions.
+
+        >> search = ParallelSearch(expand, is_goal, workers=4)
+        >> cost, goal = search.search(belief)
+    """
+
+    def __init__(self, expand, is_goal, heuristic=None, workers=None,
+            batch_size=32, capacity=100000, domain_path=None):
+        self.expand = expand
+        self.is_goal = is_goal
+        self.heuristic = heuristic or (lambda state: 0)
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.domain_path = domain_path
+        self.stats = []
+
+    def owner(self, state):
+        """ The worker that owns `state`, by its fingerprint, which (unlike its
+        hash) is the same in every worker """
+        return int(state.fingerprint()[:8], 16) % self.workers
+
+    def search(self, start):
+        """
+        Returns (cost, state) for the cheapest goal reachable from `start`, or
+        None if there is none.  Afterwards, `stats` has one dictionary of
+        counters per worker.
+        """
+        domain = start.__dict__['referential_domain']
+        if domain is not None and self.domain_path is None:
+            # built before forking, so that the workers share it
+            start.get_domain_columns()
+        self.domain_key = None
+        registered = False
+        if domain is not None:
+            self.domain_key = registry.registered_key(domain)
+            if self.domain_key is None:
+                self.domain_key = "search@%x" % id(self)
+                registry.register(domain, self.domain_key)
+                registered = True
+        self.inboxes = [multiprocessing.Queue() for _ in xrange(self.workers)]
+        self.results = multiprocessing.Queue()
+        self.stop = multiprocessing.Event()
+        self.incumbent = multiprocessing.Value('d', float('inf'))
+        self.sent = multiprocessing.Value('l', 0)
+        self.received = multiprocessing.Value('l', 0)
+        self.idle = multiprocessing.Array('b', [0] * self.workers)
+
+        self.sent.value += 1
+        self.inboxes[self.owner(start)].put([(start, 0)])
+        processes = [multiprocessing.Process(target=self.work, args=(i,)) \
+                for i in xrange(self.workers)]
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        best = None
+        stats = {}
+        try:
+            while not self.stop.is_set():
+                best = self.collect(best, stats, timeout=0.01)
+                self.check(processes, stats)
+                if self.terminated():
+                    self.stop.set()
+            while len(stats) < self.workers:
+                best = self.collect(best, stats, timeout=0.01)
+                self.check(processes, stats)
+        finally:
+            self.stop.set()
+            for process in processes:
+                process.join()
+            if registered:
+                registry.unregister(self.domain_key)
+        self.stats = [stats[i] for i in xrange(self.workers)]
+        return best
+
+    def collect(self, best, stats, timeout):
+        """ Reads one message from the workers, and returns the best goal """
+        try:
+            message = self.results.get(timeout=timeout)
+        except Queue.Empty:
+            return best
+        if message[0] == 'goal':
+            _, cost, state = message
+            if best is None or cost < best[0]:
+                best = (cost, state)
+        else:
+            _, worker, counters = message
+            stats[worker] = counters
+        return best
+
+    def check(self, processes, stats):
+        """ Raises RuntimeError if a worker exited (e.g. because `expand`
+        raised an exception) before it reported its counters, which would
+        otherwise leave the search waiting for it """
+        for worker, process in enumerate(processes):
+            if process.exitcode not in (None, 0) and worker not in stats:
+                raise RuntimeError("Search worker %i exited with code %i" \
+                        % (worker, process.exitcode))
+
+    def terminated(self):
+        """
+        Whether all workers are idle and no batch is in flight.  Workers clear
+        their idle flag before counting a received batch, so reading the
+        counters before and after the flags detects any batch that was sent
+        or received meanwhile.
+        """
+        sent, received = self.sent.value, self.received.value
+        if sent != received or not all(self.idle[:]):
+            return False
+        return self.sent.value == sent and self.received.value == received
+
+    def work(self, worker):
+        """ The loop of one worker process """
+        if self.domain_path is not None and self.domain_key is not None:
+            # the beliefstates that this worker unpickles refer to it
+            registry.register(MappedDomain(self.domain_path), self.domain_key)
+        table = TranspositionTable(self.capacity)
+        frontier = []  # (f, sequence, g, state)
+        sequence = itertools.count()
+        outboxes = [[] for _ in xrange(self.workers)]
+        counters = {'expanded': 0, 'generated': 0, 'sent': 0, 'received': 0}
+        inbox = self.inboxes[worker]
+
+        def add(state, g):
+            entry = table.lookup(state)
+            if entry is not None and entry.cost <= g:
+                return
+            table.store(state, g)
+            heapq.heappush(frontier, (g + self.heuristic(state), next(sequence), g, state))
+
+        def receive(batch):
+            self.idle[worker] = 0
+            with self.received.get_lock():
+                self.received.value += 1
+            counters['received'] += len(batch)
+            for state, g in batch:
+                add(state, g)
+
+        def send(owner):
+            with self.sent.get_lock():
+                self.sent.value += 1
+            counters['sent'] += len(outboxes[owner])
+            self.inboxes[owner].put(outboxes[owner])
+            outboxes[owner] = []
+
+        while not self.stop.is_set():
+            # read all of the batches that have arrived
+            while True:
+                try:
+                    receive(inbox.get_nowait())
+                except Queue.Empty:
+                    break
+            if frontier and frontier[0][0] < self.incumbent.value:
+                f, _, g, state = heapq.heappop(frontier)
+                # not a lookup, which would count every expansion as a hit
+                entry = table._find(state)
+                if entry is not None and entry.cost < g:
+                    continue  # reached more cheaply since
+                if self.is_goal(state):
+                    with self.incumbent.get_lock():
+                        if g < self.incumbent.value:
+                            self.incumbent.value = g
+                            self.results.put(('goal', g, state))
+                    continue
+                counters['expanded'] += 1
+                for successor, cost in self.expand(state):
+                    counters['generated'] += 1
+                    owner = self.owner(successor)
+                    if owner == worker:
+                        add(successor, g + cost)
+                    else:
+                        outboxes[owner].append((successor, g + cost))
+                        if len(outboxes[owner]) >= self.batch_size:
+                            send(owner)
+            else:
+                # nothing left below the incumbent: flush and wait for batches
+                for owner in xrange(self.workers):
+                    if outboxes[owner]:
+                        send(owner)
+                self.idle[worker] = 1
+                try:
+                    receive(inbox.get(timeout=0.01))
+                except Queue.Empty:
+                    pass
+        counters['table'] = table.stats()
+        self.results.put(('stats', worker, counters))
+        # batches left in the inboxes after stopping are not needed
+        for inbox in self.inboxes:
+            inbox.cancel_join_thread()
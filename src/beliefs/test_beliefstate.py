@@ -0,0 +1,768 @@
+"""
+Tests for BeliefState against a small, self-contained referential domain.
+"""
+import itertools
+import random
+from nose.tools import assert_raises
+from beliefs import *
+from beliefs.cells import *
+
+
+class Shape(DictCell):
+    """ A colored shape in the referential domain """
+    def __init__(self, num=0, color='yellow', shape='triangle', size=0):
+        DictCell.__init__(self, {'num': IntervalCell(num, num),
+            'color': SetIntersectionCell(['yellow', 'green', 'red'], [color]),
+            'shape': StringCell(shape),
+            'size': IntervalCell(size, size),
+            'is_filled': BoolCell(size > 61)})
+
+
+class ShapeDomain(object):
+    """ Minimal referential domain: a list of entities """
+    def __init__(self, n=4):
+        specs = [('yellow', 'triangle', 70), ('green', 'triangle', 62),
+                 ('green', 'triangle', 60), ('yellow', 'circle', 80)]
+        self.cells = []
+        for num in xrange(n):
+            color, shape, size = specs[num % len(specs)]
+            self.cells.append(Shape(num, color, shape, size + num // len(specs)))
+
+    def iter_entities(self):
+        return iter(self.cells)
+
+
+def enumerated_size(belief):
+    """ Counts the target sets by brute force """
+    n = belief.number_of_singleton_referents()
+    tlow, thigh = belief['targetset_arity'].get_tuple()
+    clow, chigh = belief['contrast_arity'].get_tuple()
+    return len([s for s in itertools.chain.from_iterable(
+        itertools.combinations(xrange(n), r) for r in xrange(1, n+1))
+        if tlow <= len(s) <= thigh and clow <= n-len(s) <= chigh])
+
+
+def test_size_is_closed_form():
+    b = BeliefState(ShapeDomain(6))
+    assert b.size() == enumerated_size(b) == 2**6-1
+    b.merge(['targetset_arity'], 2, '__ge__')
+    assert b.size() == enumerated_size(b)
+    b.merge(['contrast_arity'], 1, '__ge__')
+    assert b.size() == enumerated_size(b)
+    b.merge(['target', 'color'], 'yellow')
+    assert b.size() == enumerated_size(b) == 3
+    assert b.size() == len(list(b.iter_referents_tuples()))
+
+
+def test_size_of_large_domain():
+    b = BeliefState(ShapeDomain(200))
+    assert b.size() == 2**200-1
+    b.merge(['targetset_arity'], 1)
+    assert b.size() == 200
+
+
+def test_random_access_referents():
+    b = BeliefState(ShapeDomain(7))
+    b.merge(['contrast_arity'], 2, '__ge__')
+    tuples = list(b.iter_referents_tuples())
+    assert tuples == list(itertools.chain.from_iterable(
+        itertools.combinations(range(7), r) for r in xrange(5, 0, -1)))
+    assert len(tuples) == b.size()
+    referents = b.referents()
+    for i in xrange(len(tuples)):
+        assert b.referent_at(i) == referents[i]
+    assert b.referent_at(-1) == referents[-1]
+    assert list(b.iter_referents_tuples(30, 50)) == tuples[30:80]
+    assert list(b.iter_referents_tuples(len(tuples))) == []
+    assert_raises(IndexError, b.referent_at, len(tuples))
+
+
+def test_sample_referents():
+    b = BeliefState(ShapeDomain(5))
+    b.merge(['targetset_arity'], 3, '__le__')
+    referents = b.referents()
+    samples = b.sample_referents(2000, seed=1)
+    assert len(samples) == 2000
+    assert set(samples) == set(referents)
+    assert samples == b.sample_referents(2000, seed=1)
+    b.merge(['target', 'color'], 'red')
+    assert b.sample_referents(3) == []
+
+
+def test_columnar_entailment():
+    domain = ShapeDomain(12)
+    b = BeliefState(domain)
+
+    def expected(belief):
+        return [e['num'].low for e in domain.cells if belief['target'].is_entailed_by(e) \
+            and (belief['distractor'].empty() or not belief['distractor'].is_entailed_by(e))]
+
+    assert list(b.iter_singleton_referents_tuples()) == expected(b) == range(12)
+    b.merge(['target', 'size'], 61, '__ge__')
+    assert list(b.iter_singleton_referents_tuples()) == expected(b)
+    b.set_environment_variable('negated', True)
+    b.merge(['target', 'shape'], 'circle')
+    assert list(b.iter_singleton_referents_tuples()) == expected(b)
+    b.merge(['target', 'is_filled'], True)
+    b.merge(['target', 'color'], ['green', 'yellow'])
+    assert list(b.iter_singleton_referents_tuples()) == expected(b) == [0, 1, 4, 5, 6, 8, 9, 10]
+    assert b.number_of_singleton_referents() == 8
+
+
+def test_singleton_masks_are_incremental():
+    b = BeliefState(ShapeDomain(8))
+    b.merge(['target', 'size'], 61, '__ge__')
+    b.merge(['target', 'shape'], 'triangle')
+    assert b.number_of_singleton_referents() == 5
+    computed = []
+    columns = b.get_domain_columns()
+    part_bitmap = columns.part_bitmap
+    columns.part_bitmap = lambda keypath, cell: computed.append(keypath) or part_bitmap(keypath, cell)
+    try:
+        b.merge(['target', 'color'], 'green')
+        assert b.number_of_singleton_referents() == 3
+        c = b.copy()
+        c.merge(['target', 'size'], 62, '__ge__')
+        assert c.number_of_singleton_referents() == 2
+        assert b.number_of_singleton_referents() == 3
+    finally:
+        del columns.part_bitmap
+    assert computed == [('color',), ('size',)]
+
+
+def test_nested_changes_invalidate_masks():
+    def build(*merges):
+        belief = BeliefState(ShapeDomain(8))
+        for merge in merges:
+            belief.merge(*merge)
+        return belief
+    b = build((['target', 'size'], 61, '__ge__'), (['target', 'color'], 'green'))
+    c = b.copy()
+    assert b.number_of_singleton_referents() == c.number_of_singleton_referents() == 3
+    b['target']['size'].merge(IntervalCell(62, 63))
+    expected = build((['target', 'size'], IntervalCell(62, 63)), (['target', 'color'], 'green'))
+    assert b.number_of_singleton_referents() == expected.number_of_singleton_referents() == 2
+    assert c.number_of_singleton_referents() == 3
+    # replacing a part of 'target' directly
+    c['target'].__dict__['p']['color'] = c['target']._adopt(
+            SetIntersectionCell(['yellow', 'green', 'red'], ['yellow']))
+    c['target']._dirty()
+    assert c.number_of_singleton_referents() == 4
+    b['distractor'].shape = StringCell('triangle')
+    assert b.number_of_singleton_referents() == 0
+
+
+def test_copy_on_write():
+    b = BeliefState(ShapeDomain(8))
+    b.merge(['target', 'shape'], 'triangle')
+    b.merge(['target', 'size'], 61, '__ge__')
+    c = b.copy(copy_on_write=True)
+    assert c['target'] is b['target'] and c == b
+    c.merge(['target', 'color'], 'green')
+    c.merge(['targetset_arity'], 2, '__ge__')
+    # only the changed keypaths are cloned
+    assert c['target'] is not b['target']
+    assert c['target']['size'] is b['target']['size']
+    assert c['distractor'] is b['distractor']
+    assert 'color' not in b['target']
+    assert b['targetset_arity'].low == 0 and c['targetset_arity'].low == 2
+    assert b.number_of_singleton_referents() == 5
+    assert c.number_of_singleton_referents() == 3
+    # the parent clones the parts it shares with the copy as well
+    b.merge(['target', 'size'], 70, '__le__')
+    assert c['target']['size'].high == np.inf
+    assert b.copy() == b
+
+
+def test_hash_is_cached_until_changed():
+    def build(*merges):
+        belief = BeliefState(ShapeDomain(4))
+        for keypath, value in merges:
+            belief.merge(keypath, value)
+        return belief
+    b = build((['target', 'shape'], 'triangle'))
+    hash(b)
+    assert b.__dict__['_hash'] is not None and b['target'].__dict__['_hash'] is not None
+    b.merge(['target', 'color'], 'green')
+    assert b.__dict__['_hash'] is None and b['target'].__dict__['_hash'] is None
+    assert b['target']['shape'].__dict__['_hash'] is not None
+    assert hash(b) == hash(build((['target', 'shape'], 'triangle'), (['target', 'color'], 'green')))
+    b.set_environment_variable('negated', True)
+    assert hash(b) != hash(build((['target', 'shape'], 'triangle'), (['target', 'color'], 'green')))
+
+
+def test_nested_changes_invalidate_hashes():
+    import cPickle as pickle
+    def build():
+        belief = BeliefState(ShapeDomain(4))
+        belief.merge(['target', 'size'], 61, '__ge__')
+        return belief
+    a, b = build(), build()
+    assert a.is_equal(b) and a.fingerprint() == b.fingerprint()
+    # changing a nested cell directly reaches every DictCell that contains it
+    a['target']['size'].merge(IntervalCell(61, 63))
+    assert a.__dict__['_hash'] is None and a['target'].__dict__['_fingerprint'] is None
+    assert not a.is_equal(b) and a.fingerprint() != b.fingerprint()
+    # as in copies, and in unpickled beliefstates
+    copiers = [lambda b: b.copy(), lambda b: b.copy(copy_on_write=True),
+               lambda b: pickle.loads(pickle.dumps(b, 2))]
+    for copier in copiers:
+        b = build()
+        c = copier(b)
+        assert c.is_equal(b)
+        c['target']['size'].merge(IntervalCell(61, 63))
+        assert c.is_equal(a) and c.fingerprint() == a.fingerprint()
+        # a part shared by a copy on write changes in both beliefstates
+        shared = c['target']['size'] is b['target']['size']
+        assert b.is_equal(a) == shared
+    nested = DictCell({'label': DictCell({'size': IntervalCell(0, 10)})})
+    hash(nested)
+    nested['label']['size'].merge(IntervalCell(2, 3))
+    assert hash(nested) == hash(DictCell({'label': DictCell({'size': IntervalCell(2, 3)})}))
+
+
+def test_deferred_effects():
+    b = BeliefState(ShapeDomain(4))
+    executed = []
+    def effect(name):
+        return lambda belief: executed.append(name) or 1
+    b.add_deferred_effect(effect('NN'), 'NN')
+    b.add_deferred_effect(effect('JJ'), 'JJ')
+    b.add_deferred_effect(effect('N'), 'N')
+    b['speaker_model']['is_syntax_stacked'].value = True
+    b.add_deferred_effect(effect('NNS'), 'NNS')
+    b.add_deferred_effect(effect('NN stacked'), 'NN')
+    assert [pos for pos, _ in b.__dict__['deferred_effects']] == ['NN', 'NNS', 'NN', 'JJ', 'N']
+    c = b.copy(copy_on_write=True)
+    assert b.execute_deferred_effects('NNS') == 4
+    assert executed == ['NN stacked', 'NNS', 'NN', 'N']
+    assert [pos for pos, _ in b.__dict__['deferred_effects']] == ['JJ']
+    assert b.execute_deferred_effects('NNS') == 0
+    assert len(c.__dict__['deferred_effects']) == 5
+    # effects that do not complete stay deferred, in their places
+    executed = []
+    def contradiction(belief):
+        raise Contradiction("effect failed")
+    b.add_deferred_effect(effect('N'), 'N')
+    b.add_deferred_effect(contradiction, 'NN')
+    b.add_deferred_effect(effect('first'), 'N')
+    b['speaker_model']['is_syntax_stacked'].value = False
+    b.add_deferred_effect(effect('NNS'), 'NNS')
+    assert [pos for pos, _ in b.__dict__['deferred_effects']] == ['N', 'NN', 'N', 'JJ', 'NNS']
+    assert_raises(Contradiction, b.execute_deferred_effects, 'NNS')
+    assert executed == ['first']
+    assert [pos for pos, _ in b.__dict__['deferred_effects']] == ['NN', 'N', 'JJ', 'NNS']
+    b.__dict__['deferred_effects'].pop_triggered('NN')
+    assert b.execute_deferred_effects('NNS') == 1 and executed == ['first', 'NNS']
+    assert [pos for pos, _ in b.__dict__['deferred_effects']] == ['JJ']
+
+
+class Labeled(Shape):
+    """ A shape with a nested label """
+    def __init__(self, num=0, text='A'):
+        Shape.__init__(self, num)
+        self.label = DictCell({'text': StringCell(text), 'size': IntervalCell(num, num)})
+
+
+def test_schema_paths():
+    domain = ShapeDomain(3)
+    domain.cells.append(Labeled(3))
+    b = BeliefState(domain)
+    assert b.get_paths_for_attribute('size') == [['target', 'size']]
+    assert b.get_parts() == []
+    b.merge(['target', 'num'], 3)
+    assert b.get_paths_for_attribute('size') == [['target', 'size'], ['target', 'label', 'size']]
+    assert b.get_parts() == [['target', 'label']]
+    assert b.get_paths_for_attribute_set(['text', 'size']) == [['target', 'label']]
+    assert b.get_paths_for_attribute_set('color') == []
+    assert list(b.find_path(lambda name, cell: isinstance(cell, StringCell), on_targets=True)) \
+            == [['target', 'shape'], ['target', 'label', 'text']]
+    b = BeliefState(domain)
+    b.merge(['target', 'num'], 4, '__ge__')
+    assert b.get_parts() == [] and b.get_paths_for_attribute('size') == []
+
+
+def test_schema_paths_of_varied_entities():
+    import shutil, tempfile
+    from beliefs.columns import MappedDomain
+    domain = ShapeDomain(3)
+    # entities of the same class with different keypaths
+    domain.cells[1].label = DictCell({'text': StringCell('B')})
+    path = tempfile.mkdtemp()
+    try:
+        ColumnarDomain.for_domain(domain).export(path)
+        for referential_domain in [domain, MappedDomain(path)]:
+            paths = []
+            states = []  # which share their columns
+            for num in [0, 1, 2]:
+                b = BeliefState(referential_domain)
+                b.merge(['target', 'num'], num)
+                paths.append((b.get_parts(), b.get_paths_for_attribute('text')))
+                states.append(b)
+            assert paths == [([], []), ([['target', 'label']], [['target', 'label', 'text']]),
+                             ([], [])]
+            columns = b.get_domain_columns()
+            assert columns.is_uniform_class(Shape) is False
+            assert columns.is_uniform_class(Labeled) is True
+    finally:
+        shutil.rmtree(path)
+
+
+def ordered_values(belief, keypath, distance_from, open_interval):
+    """ Orders the singleton referents' values by hand """
+    values = sorted(set(e.get_value_from_path(keypath[1:]).low \
+            for _, e in belief.iter_singleton_referents()))
+    if distance_from == 'min':
+        return [(-np.inf if open_interval else v, v) for v in values]
+    return [(v, np.inf if open_interval else v) for v in reversed(values)]
+
+
+def test_ordered_values():
+    domain = ShapeDomain(12)
+    b = BeliefState(domain)
+    for distance_from in ['min', 'max']:
+        for open_interval in [True, False]:
+            bounds = [(c.low, c.high) for c in \
+                    b.get_ordered_values(['target', 'size'], distance_from, open_interval)]
+            assert bounds == ordered_values(b, ['target', 'size'], distance_from, open_interval)
+    assert len(b.get_ordered_values(['target', 'size'], 'min')) == 11
+    # sizes are 60, 61, 62, 62, 63, 64, 70, 71, 72, 80, 81, 82; the mean is 69
+    assert [(c.low, c.high) for c in b.get_ordered_values(['target', 'size'], 'mean')] \
+            == [(70, 70), (70, 71), (70, 72), (64, 72), (63, 72), (62, 72), (61, 72), (60, 72), (60, 80), (60, 81)]
+    second = b.get_nth_unique_value(['target', 'size'], 1, 'max')
+    assert (second.low, second.high) == (81, np.inf)
+    cached = b.__dict__['order_statistics']
+    assert b.get_nth_unique_value(['target', 'size'], 1, 'max') == second
+    assert b.__dict__['order_statistics'] is cached
+    b.merge(['target', 'color'], 'green')
+    second = b.get_nth_unique_value(['target', 'size'], 1, 'max')
+    assert (second.low, second.high) == (63, np.inf)
+    assert_raises(Contradiction, b.get_nth_unique_value, ['target', 'size'], 5, 'max')
+    b.merge(['target', 'size'], 62, '__le__')
+    assert b.get_ordered_values(['target', 'size'], 'min', False) == \
+            [IntervalCell(60, 60), IntervalCell(61, 61), IntervalCell(62, 62)]
+
+
+def test_merge_many():
+    b = BeliefState(ShapeDomain(8))
+    sequential = b.copy()
+    merges = [(['target', 'shape'], 'triangle'), (['target', 'size'], 61, '__ge__'),
+              (['targetset_arity'], 2, '__ge__')]
+    for merge in merges:
+        sequential.merge(*merge)
+    b.merge_many(merges)
+    assert b == sequential and b.size() == sequential.size()
+    assert b.__dict__['owned'] is None
+    before = b.copy()
+    assert_raises(Contradiction, b.merge_many,
+            [(['target', 'color'], 'green'), (['target', 'shape'], 'circle')])
+    assert b == before and 'color' not in b['target']
+    assert b.number_of_singleton_referents() == 5
+    b.set_environment_variable('negated', True)
+    b.merge_many([(['target', 'color'], 'green')])
+    assert 'color' in b['distractor'] and b.number_of_singleton_referents() == 2
+
+
+def test_checkpoint_rollback():
+    b = BeliefState(ShapeDomain(8))
+    b.merge(['target', 'shape'], 'triangle')
+    before = b.copy()
+    size, singletons = b.size(), b.number_of_singleton_referents()
+    mark = b.checkpoint()
+    b.merge(['target', 'size'], 61, '__ge__')
+    inner = b.checkpoint()
+    b.merge(['target', 'color'], 'green')
+    assert_raises(Contradiction, b.merge, ['target', 'shape'], 'circle')
+    b.set_environment_variable('negated', True)
+    b.merge(['target', 'size'], 63, '__ge__')
+    assert b.number_of_singleton_referents() == 2
+    b.rollback(inner)
+    assert 'color' not in b['target'] and b['distractor'].empty()
+    assert b.get_environment_variable('negated') is None
+    assert b['target']['size'].low == 61 and b.number_of_singleton_referents() == 5
+    b.rollback(mark)
+    assert b == before and hash(b) == hash(before)
+    assert b.size() == size and b.number_of_singleton_referents() == singletons
+    assert not b.in_checkpoint() and len(b.__dict__['trail']) == 0
+    mark = b.checkpoint()
+    b.merge(['target', 'color'], 'yellow')
+    b.commit(mark)
+    assert b['target']['color'].values == set(['yellow'])
+    assert_raises(ValueError, b.rollback, mark)
+
+
+def test_mapped_domain():
+    import shutil, tempfile
+    from beliefs.columns import MappedDomain
+    domain = ShapeDomain(11)
+    domain.cells.append(Labeled(11, 'B'))
+    path = tempfile.mkdtemp()
+    try:
+        ColumnarDomain.for_domain(domain).export(path)
+        mapped = MappedDomain(path)
+        assert isinstance(mapped.columns.columns[('size',)].low, np.memmap)
+        for entity, rebuilt in itertools.izip_longest(domain.iter_entities(), mapped.iter_entities()):
+            assert type(rebuilt) is type(entity) and rebuilt == entity
+        merges = [(['target', 'size'], 61, '__ge__'), (['target', 'is_filled'], True),
+                  (['target', 'color'], ['green', 'yellow']), (['target', 'shape'], 'triangle')]
+        b, c = BeliefState(domain), BeliefState(mapped)
+        for merge in merges:
+            b.merge(*merge)
+            c.merge(*merge)
+            assert list(c.iter_singleton_referents_tuples()) == list(b.iter_singleton_referents_tuples())
+        assert c.get_parts() == [] and c.size() == b.size()
+        assert c.get_nth_unique_value(['target', 'size'], 0, 'max') == \
+                b.get_nth_unique_value(['target', 'size'], 0, 'max')
+        c = BeliefState(mapped)
+        c.merge(['target', 'label', 'text'], 'b')
+        assert list(c.iter_singleton_referents_tuples()) == [11]
+        # entities are rebuilt only when they are returned
+        rebuilt = []
+        rebuild = mapped.columns.rebuild_entity
+        mapped.columns.rebuild_entity = lambda i: rebuilt.append(i) or rebuild(i)
+        c = BeliefState(mapped)
+        assert rebuilt == []
+        c.merge(['target', 'color'], 'yellow')  # from the first entity's cell
+        del rebuilt[:]
+        assert list(c.iter_singleton_referents_tuples()) == [0, 3, 4, 7, 8, 11]
+        assert list(c.iter_referents_tuples(limit=2)) == [(0, 3, 4, 7, 8, 11), (0, 3, 4, 7, 8)]
+        assert c.size() == 63 and rebuilt == []
+        assert [num.low for num, _ in c.referent_at(1)] == [0, 3, 4, 7, 8]
+        assert sorted(rebuilt) == [0, 3, 4, 7, 8]
+    finally:
+        shutil.rmtree(path)
+    # the entities' numbers are checked once, when the columns are built
+    domain = ShapeDomain(4)
+    domain.cells.reverse()
+    b = BeliefState(domain)
+    assert_raises(Exception, b.size)
+
+
+def test_range_index():
+    from beliefs.columns import IntervalColumn
+    rng = random.Random(7)
+    cells = {}
+    for i in xrange(200):
+        if rng.random() < 0.9:
+            low = rng.randint(0, 50)
+            cells[i] = IntervalCell(low, low + rng.choice([0, 0, 0, 3, np.inf]))
+    column = IntervalColumn(('size',), cells, 200)
+    for low, high in [(10, 20), (-np.inf, 5), (45, np.inf), (30, 30), (60, 70), (20, 10)]:
+        expected = sorted(i for i, cell in cells.iteritems() if low <= cell.low and cell.high <= high)
+        assert sorted(column.within(low, high)) == expected
+        if low <= high:
+            assert list(np.flatnonzero(column.entailed(IntervalCell(low, high), None, None))) == expected
+    assert list(column.distinct_values(column.present & (column.low == column.high))) == \
+            sorted(set(cell.low for cell in cells.itervalues() if cell.low == cell.high))
+
+
+RATINGS = ['poor', 'fair', 'good', 'great']
+
+class Rated(Shape):
+    """ A shape with an ordinal rating """
+    def __init__(self, num=0, color='yellow', shape='triangle', size=0):
+        Shape.__init__(self, num, color, shape, size)
+        self.rating = LinearOrderedCell(RATINGS, RATINGS[num % 4], RATINGS[num % 4])
+
+
+def test_inverted_index():
+    import shutil, tempfile
+    from beliefs.columns import MappedDomain, OrderedColumn
+    domain = ShapeDomain(0)
+    domain.cells = [Rated(num, *spec) for num, spec in enumerate(
+        [('yellow', 'triangle', 70), ('green', 'triangle', 62), ('red', 'circle', 60),
+         ('green', 'circle', 80), ('yellow', 'circle', 64), ('red', 'triangle', 66),
+         ('green', 'triangle', 61), ('yellow', 'triangle', 75), ('red', 'circle', 68)])]
+    columns = ColumnarDomain.for_domain(domain)
+    assert isinstance(columns.columns[('rating',)], OrderedColumn)
+    constraints = [(('rating',), LinearOrderedCell(RATINGS, 'fair', 'great')),
+                   (('rating',), LinearOrderedCell(RATINGS, 'poor', 'poor')),
+                   (('shape',), StringCell('circle')), (('is_filled',), BoolCell(T)),
+                   (('color',), SetIntersectionCell(['yellow', 'green', 'red'], ['green', 'red']))]
+    path = tempfile.mkdtemp()
+    try:
+        columns.export(path)
+        mapped = MappedDomain(path).columns
+        for keypath, cell in constraints:
+            expected = [cell.is_entailed_by(e[keypath[0]]) for e in domain.cells]
+            assert list(columns.part_mask(keypath, cell)) == expected
+            assert list(mapped.part_mask(keypath, cell)) == expected
+        assert [e['rating'] for e in mapped.entities] == [e['rating'] for e in domain.cells]
+        b = BeliefState(domain)
+        b.merge(['target', 'rating'], LinearOrderedCell(RATINGS, 'fair', 'good'))
+        b.merge(['target', 'color'], ['green', 'red'])
+        b.merge(['distractor', 'shape'], 'circle')
+        assert list(b.iter_singleton_referents_tuples()) == [1, 5, 6]
+    finally:
+        shutil.rmtree(path)
+
+
+class Outline(StringCell):
+    """ An outline that entails every outline that it begins """
+    def entails(self, other):
+        return other.value.startswith(self.value)
+
+
+def test_categorical_overridden_entails():
+    from beliefs.columns import CategoricalColumn, Column
+    domain = ShapeDomain(6)
+    for cell in domain.cells:
+        cell.outline = Outline(cell['shape'].value[:3])
+    columns = ColumnarDomain.for_domain(domain)
+    assert type(columns.columns[('outline',)]) is Column
+    assert type(columns.columns[('shape',)]) is CategoricalColumn
+    assert type(columns.columns[('is_filled',)]) is CategoricalColumn
+    outline = StringCell('triangle')
+    expected = [e['outline'].entails(outline) for e in domain.cells]
+    assert list(columns.part_mask(('outline',), outline)) == expected and any(expected)
+
+
+class Kinded(Shape):
+    """ A shape with a kind in the LexicaTaxonomyCell taxonomy """
+    def __init__(self, num=0, kind='shape', size=0):
+        Shape.__init__(self, num, size=size)
+        self.kind = LexicaTaxonomyCell(kind)
+
+
+def test_kind_index():
+    import shutil, tempfile
+    from beliefs.columns import MappedDomain, PosetColumn
+    domain = ShapeDomain(0)
+    kinds = ['shape', 'kindle', 'shape_with_tail', 'thing', 'shape_without_tail', 'movie', 'entity']
+    domain.cells = [Kinded(num, kind, 60 + num) for num, kind in enumerate(kinds)]
+    domain.cells[-1]['kind'].merge('thing')
+    domain.cells[-1]['kind'].merge('kindle', is_positive=False)
+    def constraint(upper=(), lower=()):
+        cell = LexicaTaxonomyCell()
+        cell.upper, cell.lower = set(upper), set(lower)
+        return cell
+    constraints = [constraint(), constraint(['thing']), constraint(['shape']),
+                   constraint(['shape_with_tail']), constraint(['event']),
+                   constraint(['thing'], ['kindle']), constraint(['kindle', 'shape'])]
+    columns = ColumnarDomain.for_domain(domain)
+    assert isinstance(columns.columns[('kind',)], PosetColumn)
+    path = tempfile.mkdtemp()
+    try:
+        columns.export(path)
+        mapped = MappedDomain(path).columns
+        for cell in constraints:
+            expected = [cell.is_entailed_by(e['kind']) for e in domain.cells]
+            assert list(columns.part_mask(('kind',), cell)) == expected
+            assert list(mapped.part_mask(('kind',), cell)) == expected
+        assert list(mapped.part_mask(('kind',), constraint(['shape']))) == \
+                [True, False, True, False, True, False, False]
+        b = BeliefState(domain)
+        b.merge(['target', 'kind'], 'thing')
+        b.set_environment_variable('negated', True)
+        b.merge(['target', 'kind'], 'shape_with_tail')
+        assert list(b.iter_singleton_referents_tuples()) == [0, 1, 3, 4, 6]
+    finally:
+        shutil.rmtree(path)
+
+
+def test_compact_pickling():
+    import cPickle as pickle
+    domain = ShapeDomain(6)
+    b = BeliefState(domain)
+    b.merge(['target', 'size'], np.float64(61), '__ge__')
+    b.merge(['target', 'color'], ['green', 'yellow'])
+    assert b.number_of_singleton_referents() == 5
+    c = pickle.loads(pickle.dumps(b, pickle.HIGHEST_PROTOCOL))
+    assert c == b and c.__dict__['referential_domain'] is domain
+    assert c.number_of_singleton_referents() == 5
+    assert type(c['target']['size'].low) is float
+    assert c['target']['color'].domain == b['target']['color'].domain
+    d = pickle.loads(pickle.dumps(b, pickle.HIGHEST_PROTOCOL))
+    assert d['target']['color'].domain is c['target']['color'].domain
+    # cells are pickled by value only, and registered domains by reference
+    assert pickle.dumps(IntervalCell(1, 2), 2).count('low') == 0
+    assert registry.key(('poor', 'good')) != registry.key(('good', 'poor'))
+    assert len(pickle.dumps(b, 2)) > len(pickle.dumps(domain, 2))
+    registry.register(domain, 'shapes(6)')
+    assert len(pickle.dumps(b, 2)) < len(pickle.dumps(domain, 2))
+    assert pickle.loads(pickle.dumps(b, 2)).__dict__['referential_domain'] is domain
+
+
+SELF_CONTAINED_SCRIPT = """
+import sys
+import cPickle as pickle
+cell, b = pickle.load(sys.stdin)
+print sorted(cell.get_values()), b.number_of_singleton_referents()
+"""
+
+def test_self_contained_pickling():
+    import os, subprocess, sys
+    import cPickle as pickle
+    b = BeliefState(ShapeDomain(6))
+    b.merge(['target', 'color'], ['green', 'yellow'])
+    cell = SetIntersectionCell(['a', 'b', 'c'], ['a', 'b'])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    script = subprocess.Popen([sys.executable, '-c', SELF_CONTAINED_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    out, _ = script.communicate(pickle.dumps((cell, b), 2))
+    assert script.returncode == 0
+    assert out.split() == ["['a',", "'b']", str(b.number_of_singleton_referents())]
+
+
+FINGERPRINT_SCRIPT = """
+from beliefs import *
+from beliefs.test_beliefstate import ShapeDomain
+b = BeliefState(ShapeDomain(4))
+b.merge(['target', 'color'], ['green', 'yellow'])
+b.merge(['target', 'size'], 61, '__ge__')
+print b.fingerprint()
+"""
+
+def test_fingerprint():
+    import os, subprocess, sys
+    import cPickle as pickle
+    b = BeliefState(ShapeDomain(4))
+    b.merge(['target', 'color'], ['green', 'yellow'])
+    b.merge(['target', 'size'], 61, '__ge__')
+    c = BeliefState(ShapeDomain(4))
+    c.merge(['target', 'size'], 61.0, '__ge__')
+    c.merge(['target', 'color'], ['yellow', 'green'])
+    assert len(b.fingerprint()) == 32 and b.fingerprint() == c.fingerprint()
+    assert pickle.loads(pickle.dumps(b, 2)).fingerprint() == b.fingerprint()
+    # cached until changed, and then only recomputed along the changed keypath
+    size = b['target']['size'].fingerprint()
+    b.merge(['target', 'color'], 'green')
+    assert b.__dict__['_fingerprint'] is None and b['target'].__dict__['_fingerprint'] is None
+    assert b['target']['size'].__dict__['_fingerprint'] == size
+    assert b.fingerprint() != c.fingerprint()
+    fval = c.fingerprint()
+    c.set_pos('NP')
+    assert c.fingerprint() != fval
+    # the same in a process with another hash seed
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.check_output([sys.executable, '-R', '-c', FINGERPRINT_SCRIPT], env=env)
+    d = BeliefState(ShapeDomain(4))
+    d.merge(['target', 'color'], ['green', 'yellow'])
+    d.merge(['target', 'size'], 61, '__ge__')
+    assert out.strip() == d.fingerprint()
+    # wide dicts
+    wide = DictCell(dict(('k%i' % i, IntervalCell(i, i)) for i in xrange(60)))
+    assert hash(wide) == hash(DictCell(dict(wide)))
+    assert wide.fingerprint() != DictCell().fingerprint()
+    # functions are fingerprinted by name, if they have one that imports them
+    from beliefs.cells import fingerprint as fingerprints
+    assert fingerprints.fingerprint(enumerated_size) != fingerprints.fingerprint(ordered_values)
+    def make_effect(x):
+        return lambda belief: x
+    for value in [make_effect(1), enumerated_size.__call__, object(), iter([])]:
+        assert_raises(TypeError, fingerprints.fingerprint, value)
+
+
+def test_result_cache():
+    import os, shutil, tempfile
+    from beliefs.cache import ResultCache
+    path = os.path.join(tempfile.mkdtemp(), 'results.sqlite')
+    def build(n=0):
+        b = BeliefState(ShapeDomain(6))
+        b.merge(['target', 'color'], 'green')
+        b.merge(['target', 'num'], n, '__ge__')
+        return b
+    def results(b):
+        return (b.size(), b.number_of_singleton_referents(),
+                [v.get_tuple() for v in b.get_ordered_values(['target', 'size'], 'max')])
+    try:
+        BeliefState.result_cache = ResultCache(path, capacity=10)
+        expected = results(build())
+        assert expected == (7, 3, [(63, np.inf), (62, np.inf), (60, np.inf)])
+        assert BeliefState.result_cache.stats()['misses'] == 3
+        BeliefState.result_cache.close()
+        # another process (or run) reads the results back
+        cache = BeliefState.result_cache = ResultCache(path, capacity=10)
+        b = build()
+        assert results(b) == expected
+        assert cache.hits == 3 and cache.misses == 0 and len(cache) == 3
+        # a result depends only on the parts of the beliefstate named by its
+        # method, which looks it up once
+        b.set_pos('NP')
+        assert b.size() == 7 and cache.misses == 0
+        b.merge(['target', 'size'], 62, '__ge__')
+        assert b.size() == 3 and cache.misses == 1
+        # ordered values are looked up only if they are not cached in memory
+        hits = cache.hits
+        b.get_ordered_values(['target', 'size'], 'max')
+        b.get_ordered_values(['target', 'size'], 'max')
+        assert cache.hits + cache.misses == hits + 2
+        # the least recently used results are evicted
+        for n in xrange(1, 9):
+            build(n).number_of_singleton_referents()
+        assert len(cache) <= 10 and cache.evictions > 0
+        assert cache.get(cache.key(build(), 'size', (), BeliefState.size.parts))[0] is False
+        cache.close()
+    finally:
+        BeliefState.result_cache = None
+        shutil.rmtree(os.path.dirname(path))
+
+
+def test_result_cache_processes():
+    import multiprocessing, os, shutil, tempfile
+    from beliefs.cache import ResultCache
+    path = os.path.join(tempfile.mkdtemp(), 'results.sqlite')
+    def build(n):
+        b = BeliefState(ShapeDomain(30))
+        b.merge(['target', 'num'], n, '__ge__')
+        return b
+    def work(first):
+        for n in xrange(first, first + 20):
+            assert build(n).size() == 2 ** (30 - n) - 1
+    try:
+        cache = BeliefState.result_cache = ResultCache(path, capacity=10)
+        build(0).size()
+        build(0).size()  # a hit, which does not write
+        # forked processes share the cache, and none of them holds it locked
+        processes = [multiprocessing.Process(target=work, args=(first,)) for first in [0, 1]]
+        for process in processes:
+            process.start()
+        work(2)
+        for process in processes:
+            process.join()
+        assert [process.exitcode for process in processes] == [0, 0]
+        # the least recently used results of all processes were evicted
+        build(25).size()
+        cache.close()
+        cache = ResultCache(path)
+        assert len(cache) <= 10
+        assert cache.get(cache.key(build(25), 'size', (), BeliefState.size.parts))[0]
+        cache.close()
+    finally:
+        BeliefState.result_cache = None
+        shutil.rmtree(os.path.dirname(path))
+
+
+def test_result_cache_nested_changes():
+    import os, shutil, tempfile
+    from beliefs.cache import ResultCache
+    path = os.path.join(tempfile.mkdtemp(), 'results.sqlite')
+    def build():
+        b = BeliefState(ShapeDomain(6))
+        b.merge(['target', 'color'], 'green')
+        b.merge(['target', 'size'], 61, '__ge__')
+        return b
+    def results(b):
+        return (b.size(), b.number_of_singleton_referents(),
+                [v.get_tuple() for v in b.get_ordered_values(['target', 'size'], 'max')])
+    expected = results(build())
+    fresh = build()
+    fresh.merge(['target', 'size'], IntervalCell(63, 63))
+    changed = results(fresh)
+    assert changed != expected
+    try:
+        cache = BeliefState.result_cache = ResultCache(path)
+        b = build()
+        c = b.copy()
+        assert results(b) == expected and results(c) == expected
+        key = lambda state: cache.key(state, 'size', (), BeliefState.size.parts)
+        before = key(b)
+        # changing a nested cell directly changes the key of the results
+        b['target']['size'].merge(IntervalCell(63, 63))
+        assert key(b) != before and key(c) == before
+        assert results(b) == changed and results(c) == expected
+        assert key(b) == key(fresh)
+        cache.close()
+    finally:
+        BeliefState.result_cache = None
+        shutil.rmtree(os.path.dirname(path))
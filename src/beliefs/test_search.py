@@ -0,0 +1,109 @@
+"""
+Tests for the search helpers over BeliefStates.
+"""
+from nose.tools import assert_raises
+from beliefs import *
+from beliefs.search import *
+from beliefs.cells import registry
+from beliefs.test_beliefstate import ShapeDomain
+
+
+def plural(belief):
+    belief.merge(['targetset_arity'], 2, '__ge__')
+
+def yellow(belief):
+    belief.merge(['target', 'color'], 'yellow')
+
+
+def test_transposition_table():
+    start = BeliefState(ShapeDomain(6))
+    table = TranspositionTable(capacity=2)
+    assert table.lookup(start) is None
+    table.store(start, 0)
+
+    plural_yellow = start.copy(copy_on_write=True)
+    plural(plural_yellow)
+    yellow(plural_yellow)
+    entry = table.store(plural_yellow, 2)
+    assert entry.size == plural_yellow.size() == 4
+
+    yellow_plural = start.copy(copy_on_write=True)
+    yellow(yellow_plural)
+    plural(yellow_plural)
+    found = table.lookup(yellow_plural)
+    assert found is entry and found.state is plural_yellow
+    assert table.store(yellow_plural, 1).cost == 1
+
+    only_yellow = start.copy()
+    yellow(only_yellow)
+    assert only_yellow not in table
+    table.store(only_yellow, 1)
+    # the start state was the least recently used
+    assert len(table) == 2 and table.evictions == 1
+    assert table.lookup(start) is None
+    assert table.hits == 1 and table.misses == 2
+    assert table.hit_rate() == 1.0 / 3
+
+
+ACTIONS = [(['target', 'color'], 'yellow'), (['target', 'color'], 'green'),
+           (['target', 'shape'], 'circle'), (['target', 'shape'], 'triangle'),
+           (['target', 'size'], 62, '__ge__'), (['target', 'size'], 70, '__le__'),
+           (['target', 'is_filled'], True)]
+
+def expand(state):
+    for action in ACTIONS:
+        successor = state.copy(copy_on_write=True)
+        try:
+            successor.merge(*action)
+        except (Contradiction, CellConstructionFailure):
+            continue
+        if successor.number_of_singleton_referents() > 0:
+            yield successor, 1
+
+def is_unique(state):
+    return state.number_of_singleton_referents() == 1
+
+
+def test_parallel_search():
+    start = BeliefState(ShapeDomain(8))
+    search = ParallelSearch(expand, is_unique, workers=3, batch_size=2)
+    cost, goal = search.search(start)
+    # only entity 0 (yellow, size 70) can be singled out, with two constraints
+    assert cost == 2 and is_unique(goal)
+    assert goal.__dict__['referential_domain'] is start.__dict__['referential_domain']
+    assert len(search.stats) == 3
+    assert sum(stats['received'] for stats in search.stats) > 0
+    # a single worker expands every state itself, and looks up every state
+    # that it generates or receives once
+    search = ParallelSearch(expand, is_unique, workers=1)
+    cost, goal = search.search(start)
+    assert cost == 2
+    stats = search.stats[0]
+    assert stats['table']['hits'] + stats['table']['misses'] == \
+            stats['generated'] + stats['received']
+    assert ParallelSearch(expand, lambda state: False, workers=2).search(start) is None
+    assert registry.registered_key(start.__dict__['referential_domain']) is None
+
+
+def test_parallel_search_mapped_domain():
+    import shutil, tempfile
+    start = BeliefState(ShapeDomain(8))
+    path = tempfile.mkdtemp()
+    try:
+        start.get_domain_columns().export(path)
+        search = ParallelSearch(expand, is_unique, workers=2, domain_path=path)
+        cost, goal = search.search(start)
+        assert cost == 2 and is_unique(goal)
+        assert goal.__dict__['referential_domain'] is start.__dict__['referential_domain']
+    finally:
+        shutil.rmtree(path)
+
+
+def failing_expand(state):
+    raise ValueError("expansion failed")
+
+
+def test_parallel_search_worker_failure():
+    start = BeliefState(ShapeDomain(4))
+    search = ParallelSearch(failing_expand, lambda state: False, workers=2)
+    assert_raises(RuntimeError, search.search, start)